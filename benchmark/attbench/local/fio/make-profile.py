@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# Created on: 10/18/2026
+
+# Build an IOArbiter device profile from the fio outputs of one device.
+# Usage: ./make-profile.py <res_dir> <dev> [-o <outdir>]
+#   res_dir: a result directory of run.sh, tested against <dev> only
+#   dev:     block device name (e.g., sdb)
+# The profile is written to <outdir>/<vendor>_<model>.json, which is
+# where IOArbiter (qosctrl/src/cinder/common/ioarbperf.py) looks for it.
+
+import os, sys, re, glob, json, argparse
+
+def parse_bs(bs):
+    # e.g., 4k -> 4096, 1024k -> 1048576, 1m -> 1048576, 512b -> 512
+    units = {'b': 1, 'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+    unit = bs[-1].lower()
+    if unit in units:
+        return int(float(bs[:-1]) * units[unit])
+    return int(bs)
+
+def read_sysfs(dev, attr):
+    path = '/sys/block/%s/device/%s' % (dev, attr)
+    if not os.path.exists(path):
+        return 'unknown'
+    with open(path) as f:
+        return f.read().strip()
+
+def get_profile_filename(vendor, model):
+    # Keep in sync with ioarbperf.get_profile_path().
+    name = '%s_%s' % (vendor.strip(), model.strip())
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.json'
+
+def parse_fio_output(filename):
+    # Calculate total iops/bw the same way parse-and-report-influxdb.py does.
+    with open(filename) as data_file:
+        fio_output = json.load(data_file)
+
+    total_iops = 0
+    total_bw = 0
+    for job in fio_output['jobs']:
+        total_iops = total_iops + job['read']['iops'] + job['write']['iops']
+        total_bw = total_bw + job['read']['bw'] + job['write']['bw']
+
+    # fio reports bw in KB/s.
+    return total_iops, total_bw / 1024.
+
+def main(args):
+    # Output files are named as <rw>-<bs>-<readratio>-<iodepth>-<numjobs>.json
+    samples = {}
+    for outfile in sorted(glob.glob(os.path.join(args.res_dir, 'out', '*.json'))):
+        fields = os.path.basename(outfile)[:-len('.json')].split('-')
+        if len(fields) != 5:
+            print("Skip `%s`: unknown file name." % outfile)
+            continue
+        rw, bs, readratio, iodepth, numjobs = fields
+
+        try:
+            iops, bw = parse_fio_output(outfile)
+        except (ValueError, KeyError) as err:
+            print("Skip `%s`: %s" % (outfile, err))
+            continue
+
+        # Keep the best result of each (bs, readratio, iodepth) point
+        # across access patterns and numbers of jobs.
+        key = (parse_bs(bs), int(readratio), int(iodepth))
+        if key not in samples or samples[key]['iops'] < iops:
+            samples[key] = {'bs': key[0], 'readratio': key[1],
+                            'iodepth': key[2], 'iops': round(iops, 2),
+                            'bw': round(bw, 2)}
+
+    if len(samples) == 0:
+        print("No fio output found in %s" % args.res_dir)
+        sys.exit(1)
+
+    vendor = read_sysfs(args.dev, 'vendor')
+    model = read_sysfs(args.dev, 'model')
+    profile = {'vendor': vendor, 'model': model,
+               'samples': [samples[k] for k in sorted(samples)]}
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    path = os.path.join(args.outdir, get_profile_filename(vendor, model))
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+
+    print("Profile of %s (%s %s, %d samples): %s" %
+          (args.dev, vendor, model, len(samples), path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build an IOArbiter device \
+            profile from fio outputs.')
+    parser.add_argument("res_dir", help="result directory of run.sh")
+    parser.add_argument("dev", help="block device name (e.g., sdb)")
+    parser.add_argument("-o", "--outdir", default=".", help="output directory (default: %(default)s)")
+    main(parser.parse_args())
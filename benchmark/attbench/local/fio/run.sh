@@ -13,15 +13,21 @@ FIO_IODEPTHLIST=${FIO_IODEPTHLIST:-"1"}		# e.g., "1 8 16 32 64"
 FIO_NUMJOBSLIST=${FIO_NUMJOBSLIST:-"1"}		# e.g., "1 8 16 32"
 
 # Prepare for result dirs
-n=0
-while ! mkdir ../res-$n
-do
-    n=$((n+1))
-done
-export res_dir=../res-$n
+if [ -n "$FIO_RES_DIR" ]; then
+    # given by the caller (e.g., start.py in profile mode)
+    export res_dir=$FIO_RES_DIR
+    mkdir -p $res_dir
+else
+    n=0
+    while ! mkdir ../res-$n
+    do
+        n=$((n+1))
+    done
+    export res_dir=../res-$n
+fi
 echo "mkdir: create directory ‘$res_dir’"
-mkdir $res_dir/job
-mkdir $res_dir/out
+mkdir -p $res_dir/job
+mkdir -p $res_dir/out
 
 
 # random test
@@ -2,7 +2,7 @@
 # Author: Hee Won Lee <knowpd@research.att.com>
 # Created on 12/8/2017
 
-supported_benchmark_tool = ['fio', 'cosbench']
+supported_benchmark_tool = ['fio', 'cosbench', 'profile']
 
 import os, sys, subprocess, copy, argparse, yaml
 
@@ -29,7 +29,7 @@ def run_bash(cmd):
 def arg_handler():
     parser = argparse.ArgumentParser(description='This program runs various benchmark \
             tools with a single config file.')
-    parser.add_argument("benchmark_tool", help="fio, cosbench")
+    parser.add_argument("benchmark_tool", help="fio, cosbench, profile (fio sweep per device -> IOArbiter device profiles)")
     parser.add_argument("-c", "--config", default="config.yaml", help="config file (default: %(default)s)")
     args = parser.parse_args()
     main(args)
@@ -100,6 +100,27 @@ def fio_eta():
 
     return eta, eta_unit, int(runtime), cnt
 
+def fio_profile():
+    # Sweep each device alone, so that results describe a single device,
+    # and turn the results into an IOArbiter device profile.
+    devlist = os.environ.get('FIO_DEVLIST', '').split()
+    outdir = os.environ.get('PROFILE_OUTDIR', '/var/lib/cinder/ioarb-perf')
+
+    for dev in devlist:
+        n = 0
+        while os.path.exists('profile-%s-%d' % (dev, n)):
+            n = n + 1
+        res_dir = 'profile-%s-%d' % (dev, n)
+
+        os.environ['FIO_DEVLIST'] = dev
+        os.environ['FIO_RES_DIR'] = '../' + res_dir
+        print("Profiling %s: %s" % (dev, res_dir))
+        run_bash('cd fio; ./run.sh')
+        run_bash('cd fio; ./make-profile.py ../%s %s -o %s' % (res_dir, dev, outdir))
+
+    os.environ['FIO_DEVLIST'] = ' '.join(devlist)
+    os.environ.pop('FIO_RES_DIR', None)
+
 def main(args):
     # Generate env variables
     load_config(args.config)
@@ -107,9 +128,16 @@ def main(args):
     # ETA
     if args.benchmark_tool == 'fio':
         print("ETA: %.1f+ %s (each runtime: %d sec, count:  %d)" % fio_eta())
+    elif args.benchmark_tool == 'profile':
+        eta, eta_unit, runtime, cnt = fio_eta()
+        ndev = len(os.environ.get('FIO_DEVLIST', '').split())
+        print("ETA: %.1f+ %s x %d devices (each runtime: %d sec, count:  %d)"
+              % (eta, eta_unit, ndev, runtime, cnt))
 
     # Run
-    if args.benchmark_tool in supported_benchmark_tool:
+    if args.benchmark_tool == 'profile':
+        fio_profile()
+    elif args.benchmark_tool in supported_benchmark_tool:
         cmd = ('cd ' +  args.benchmark_tool + '; ./run.sh')
         run_bash(cmd)
     else:
@@ -16,6 +16,7 @@
 
 """Container-related utilities and helpers."""
 
+import json
 import os
 import socket
 import ConfigParser
@@ -24,10 +25,10 @@ from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log as logging
 
+from cinder.brick.local_dev import ioarbhelper
 from cinder.brick.local_dev import lvm as brick_lvm
 from cinder.common import ioarbparams as ioarbiter
 from cinder.i18n import _, _LE, _LI
-from cinder import utils
 
 #CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
@@ -71,8 +72,13 @@ def _read_cinder_conf(path='/etc/cinder/cinder.conf'):
 def get_cmdprefix_for_exec_in_cont(config):
     return ['docker', 'exec', '-t', config['container_name']];
 
-def create_cinder_conf_for_container(blkdev, stspec, config_info):
-    """Automatically create cinder.conf for container."""
+def create_cinder_conf_for_container(blkdev, stspec, config_info,
+                                     devinfo=None):
+    """Automatically create cinder.conf for container.
+
+       devinfo: block device information of the array members. Their
+       profiled performance is used to set the qos budget if available.
+    """
     
     info = {}
     if config_info is not None:
@@ -117,8 +123,12 @@ def create_cinder_conf_for_container(blkdev, stspec, config_info):
     if stspec is not None:
         config.set(backend, 'ioarb_raidconf', stspec['raidconf'])
         config.set(backend, 'ioarb_ndisk', stspec['ndisk'])
-        perfmat = ioarbiter.get_perf_dict(int(stspec['ndisk']), stspec['medium'], 'rw')
-        config.set(backend, 'ioarb_total_iops_4k', perfmat[stspec['raidconf']])
+        budget = ioarbiter.calculate_qos_budget(
+            devinfo, int(stspec['ndisk']), stspec['medium'])
+        for rtype in ioarbiter.QOS_RTYPES:
+            total_key = ioarbiter.CAPS_KEY_MAPPING[rtype][0]
+            config.set(backend, 'ioarb_' + total_key,
+                       budget[rtype][stspec['raidconf']])
     
     # save it to the designated location.
     # [MRA] Todo: file creation should be done by rootwrapper. 
@@ -128,14 +138,69 @@ def create_cinder_conf_for_container(blkdev, stspec, config_info):
     return info
 
 
+def _get_container_mounts(config):
+    """(source, destination) of the bind mounts of a container."""
+    cinder_root = '/usr/lib/python2.7/dist-packages/cinder'
+    mounts = [(config['config_path'], '/etc/cinder/cinder.conf')]
+    for module in ['ioarbresv', 'ioarbparams', 'ioarbperf', 'ioarbthrottle',
+                   'ioarbwipe']:
+        path = '%s/common/%s.py' % (cinder_root, module)
+        mounts.append((path, path))
+    # the whole directory, as reservation files are replaced by rename.
+    resv_dir = os.path.dirname(config['resv_info'])
+    mounts.append((resv_dir, resv_dir))
+    mounts.append(('/etc/hosts', '/etc/hosts-hostmachine'))
+    return mounts
+
+def _is_container_outdated(config, root_helper):
+    """Check if a container lacks the bind mounts it is created with now.
+
+       Containers created by older versions bind-mount the reservation
+       file itself. Such a mount keeps the inode it was created with,
+       so once the file is compacted (replaced by rename) the container
+       reads and writes an orphaned copy.
+    """
+    cmd = ['docker', 'inspect', '--format', '{{json .Mounts}}',
+           config['container_name']]
+    try:
+        (out, _err) = ioarbhelper.execute(*cmd, root_helper=root_helper
+                                        , run_as_root=True)
+    except processutils.ProcessExecutionError as err:
+        LOG.exception(_LE('Error inspecting container mounts'))
+        LOG.error(_LE('Cmd     :%s') % err.cmd)
+        LOG.error(_LE('StdOut  :%s') % err.stdout)
+        LOG.error(_LE('StdErr  :%s') % err.stderr)
+        raise
+
+    mounted = set(mount['Destination'] for mount in json.loads(out) or [])
+    required = set(dst for _src, dst in _get_container_mounts(config))
+    return bool(required - mounted) or config['resv_info'] in mounted
+
+def _remove_container(container_name, root_helper):
+    cmd = ['docker', 'rm', '-f', container_name]
+    try:
+        ioarbhelper.execute(*cmd, root_helper=root_helper
+                          , run_as_root=True)
+    except processutils.ProcessExecutionError as err:
+        LOG.exception(_LE('Error removing container.'))
+        LOG.error(_LE('Cmd     :%s') % err.cmd)
+        LOG.error(_LE('StdOut  :%s') % err.stdout)
+        LOG.error(_LE('StdErr  :%s') % err.stderr)
+        raise
+
 def check_container_is_running(config, root_helper):
-    """Check if the container is already running."""
+    """Check if the container is already running.
+
+       A running container with outdated bind mounts is removed, and
+       config['outdated'] is set, so that the caller creates it again.
+       config['resv_info'] has to be set.
+    """
 
     LOG.debug('[MRA] entered check_container_is_running()')
 
     cmd = ['docker', 'ps', '-f', ('name=%s' % config['container_name']), '-q']
     try:
-        (out, _err) = utils.execute(*cmd, root_helper=root_helper
+        (out, _err) = ioarbhelper.execute(*cmd, root_helper=root_helper
                                         , run_as_root=True)
     except processutils.ProcessExecutionError as err:
         LOG.exception(_LE('Error checking running docker instances'))
@@ -147,7 +212,13 @@ def check_container_is_running(config, root_helper):
     if out is not None and len(out) > 10:
         LOG.debug('[MRA] existed. container-id: %(contid)s'
                   % {'contid': out})
-        config['container_id'] = out.strip()
+        if _is_container_outdated(config, root_helper):
+            LOG.info(_LI('[MRA] recreating container %s with current '
+                         'mounts.') % config['container_name'])
+            _remove_container(config['container_name'], root_helper)
+            config['outdated'] = True
+        else:
+            config['container_id'] = out.strip()
     else:
         LOG.debug('[MRA] container does not exist: %(out)s' 
                   % {'out': out})
@@ -161,19 +232,13 @@ def create_container_instance(config, root_helper):
     LOG.debug('[MRA] entered create_container_instance()')
 
     # run a docker instance.
-    cinder_root = '/usr/lib/python2.7/dist-packages/cinder'
-    resv = '%s/common/ioarbresv.py' % cinder_root
-    params = '%s/common/ioarbparams.py' % cinder_root
-
     cmd = ['docker', 'run', '--name', config['container_name'], '-it', 
-           '-p', '3260', '-d', '--privileged', 
-           '-v', '%s:%s' % (config['config_path'], '/etc/cinder/cinder.conf'),
-           '-v', '%s:%s' % (resv, resv),
-           '-v', '%s:%s' % (params, params),
-           '-v', '%s:%s' % (config['resv_info'], config['resv_info']),
-           '-v', '/etc/hosts:/etc/hosts-hostmachine', config['container_image']]
+           '-p', '3260', '-d', '--privileged']
+    for src, dst in _get_container_mounts(config):
+        cmd += ['-v', '%s:%s' % (src, dst)]
+    cmd.append(config['container_image'])
     try:
-        (out, _err) = utils.execute(*cmd, root_helper=root_helper
+        (out, _err) = ioarbhelper.execute(*cmd, root_helper=root_helper
                                        , run_as_root=True)
     except processutils.ProcessExecutionError as err:
         LOG.exception(_LE('Error running docker instance'))
@@ -195,7 +260,7 @@ def configure_container_instance(config, root_helper):
            "--format='{{(index (index .NetworkSettings.Ports \"3260/tcp\") 0).HostPort}}'",
            config['container_name']]
     try:
-        (out, _err) = utils.execute(*cmd, root_helper=root_helper
+        (out, _err) = ioarbhelper.execute(*cmd, root_helper=root_helper
                                        , run_as_root=True)
     except processutils.ProcessExecutionError as err:
         LOG.exception(_LE('Error inspecting container port mapping'))
@@ -215,7 +280,7 @@ def configure_container_instance(config, root_helper):
     cmd = ['docker', 'exec', '-t', config['container_name'],
            'ioarbiter-conf.sh', hostport]
     try:
-        (out, _err) = utils.execute(*cmd, root_helper=root_helper
+        (out, _err) = ioarbhelper.execute(*cmd, root_helper=root_helper
                                        , run_as_root=True)
     except processutils.ProcessExecutionError as err:
         LOG.exception(_LE('Error configuring container instance'))
@@ -228,7 +293,7 @@ def configure_container_instance(config, root_helper):
     cmd = ['docker', 'exec', '-t', config['container_name'],
            'hostname', config['container_name']]
     try:
-        (out, _err) = utils.execute(*cmd, root_helper=root_helper
+        (out, _err) = ioarbhelper.execute(*cmd, root_helper=root_helper
                                        , run_as_root=True)
     except processutils.ProcessExecutionError as err:
         LOG.exception(_LE('Error changing container hostname.'))
@@ -248,7 +313,7 @@ def restart_processes_in_container(container_name, svclist, root_helper):
     for svc in svclist:
         cmd = ['docker', 'exec', '-t', container_name, 'service', svc, 'restart']
         try:
-            utils.execute(*cmd, root_helper=root_helper
+            ioarbhelper.execute(*cmd, root_helper=root_helper
                              , run_as_root=True)
         except processutils.ProcessExecutionError as err:
             LOG.exception(_LE('Error restarting services in container.'))
@@ -265,7 +330,7 @@ def remove_cont_cinder_volume(root_helper, arrdev):
     cont_name = _get_container_name(arrdev)
     cmd = ['docker', 'stop', cont_name]
     try:
-        utils.execute(*cmd, root_helper=root_helper
+        ioarbhelper.execute(*cmd, root_helper=root_helper
                           , run_as_root=True)
     except processutils.ProcessExecutionError as err:
         if "no such id" in err.stderr:
@@ -281,7 +346,7 @@ def remove_cont_cinder_volume(root_helper, arrdev):
     # remove docker instance.
     cmd = ['docker', 'rm', cont_name]
     try:
-        utils.execute(*cmd, root_helper=root_helper
+        ioarbhelper.execute(*cmd, root_helper=root_helper
                           , run_as_root=True)
     except processutils.ProcessExecutionError as err:
         LOG.exception(_LE('Error removing container.'))
@@ -292,9 +357,9 @@ def remove_cont_cinder_volume(root_helper, arrdev):
 
     # remove reservation info.
     resv_fpath = '/var/lib/cinder/ioarb-resv/resv-' + arrdev.split('/')[-1]
-    cmd = ['rm', '-f', resv_fpath]
+    cmd = ['rm', '-f', resv_fpath, resv_fpath + '.snap']
     try:
-        utils.execute(*cmd, root_helper=root_helper
+        ioarbhelper.execute(*cmd, root_helper=root_helper
                           , run_as_root=True)
     except processutils.ProcessExecutionError as err:
         LOG.exception(_LE('Error removing resv info.'))
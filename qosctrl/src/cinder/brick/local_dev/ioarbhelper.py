@@ -0,0 +1,429 @@
+#    Copyright (c) 2015 AT&T Labs Research
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#    Author: Moo-Ryong Ra, mra@research.att.com
+
+"""Privileged helper daemon
+
+   Running a command as root through the root helper forks and execs
+   cinder-rootwrap each time. The helper is a long-lived root process
+   that listens on a local Unix socket and runs whitelisted commands
+   (lvm, mdadm, docker, ..) directly, and reads sysfs/procfs files.
+
+   Start it as root on the storage node:
+
+       python -m cinder.brick.local_dev.ioarbhelper \\
+           --socket /var/run/cinder/ioarb-helper.sock --user cinder
+
+   Requests and replies are JSON, one per line:
+
+       {"op": "execute", "cmd": [...], "process_input": null}
+           -> {"exit_code": 0, "stdout": "..", "stderr": ".."}
+       {"op": "read", "path": "/sys/block/sdb/size"}
+           -> {"data": ".."}  or  {"error": ".."}
+
+   execute() is a drop-in for processutils.execute(): commands to run as
+   root go to the helper when one is configured (configure()), anything
+   else runs as before. Connections are kept and reused.
+"""
+
+import argparse
+import grp
+import json
+import os
+import pwd
+import socket
+import SocketServer
+import stat
+import subprocess
+import threading
+
+from oslo_concurrency import processutils as putils
+from oslo_log import log as logging
+
+from cinder.common import ioarbresv
+
+LOG = logging.getLogger(__name__)
+
+# Commands the helper runs, by name only: they are looked up in
+# EXEC_DIRS, like rootwrap's exec_dirs. 'env VAR=.. cmd' is checked by
+# cmd, and so is a command run by a wrapper (see WRAPPERS).
+ALLOWED_COMMANDS = [
+    'blockdev', 'cat', 'cgcreate', 'cgexec', 'cgset', 'dd', 'docker',
+    'ionice', 'lvchange', 'lvconvert', 'lvcreate', 'lvdisplay',
+    'lvextend', 'lvm', 'lvremove', 'lvrename', 'lvs', 'mdadm', 'nice',
+    'pvcreate', 'pvremove', 'pvs', 'rm', 'shred', 'tee', 'udevadm',
+    'vgchange', 'vgcreate', 'vgremove', 'vgs', 'wipefs' ]
+
+# PATH commands are run with. Nothing else of the environment is passed.
+EXEC_DIRS = ['/sbin', '/usr/sbin', '/bin', '/usr/bin']
+
+# Variables 'env' may set. (LVM_CMD_PREFIX and lvm_conf of brick LVM)
+ENV_VARS = ['LC_ALL', 'LVM_SYSTEM_DIR']
+
+# Commands that run the command given after their options:
+# name -> (options, options taking an argument)
+WRAPPERS = {
+    'cgexec': (['--sticky'], ['-g']),
+    'ionice': (['-t'], ['-c', '-n']),
+    'nice': ([], ['-n']),
+}
+
+# Where 'read' requests and 'cat' may read, and 'tee' may write.
+READ_PREFIXES = ['/sys/', '/proc/']
+WRITE_PREFIXES = ['/sys/fs/cgroup/']
+
+# What 'rm' may remove: reservation files of removed arrays.
+REMOVE_PREFIXES = [ioarbresv.DEFAULT_RESV_DIR]
+
+# Commands that write to the block devices given as arguments ('dd'
+# writes to of=).
+DEVICE_COMMANDS = ['shred', 'wipefs']
+
+# docker: subcommands, and what they may touch. Containers are ours
+# (see ioarbcontainer._get_container_name) and run our image with
+# bind mounts of cinder files only.
+DOCKER_SUBCOMMANDS = ['exec', 'inspect', 'ps', 'rm', 'run', 'stop']
+CONTAINER_TAG = '-ioarbcont-'
+CONTAINER_IMAGE_PREFIX = 'ioarb/'
+MOUNT_PREFIXES = ['/var/lib/cinder/',
+                  '/usr/lib/python2.7/dist-packages/cinder/']
+MOUNT_FILES = ['/etc/hosts']
+# Commands 'docker exec' runs in a container besides ALLOWED_COMMANDS.
+CONTAINER_COMMANDS = ['hostname', 'ioarbiter-conf.sh', 'service']
+
+# None: no helper, use the root helper.
+_socket_path = None
+_client = None
+
+
+def _get_command(cmd):
+    """The command run by cmd, past 'env' and its assignments.
+
+       Raise ValueError if 'env' sets a variable not in ENV_VARS.
+    """
+    cmd = list(cmd)
+    if cmd and cmd[0] == 'env':
+        cmd = cmd[1:]
+        while cmd and '=' in cmd[0]:
+            if not cmd[0].split('=')[0] in ENV_VARS:
+                raise ValueError('variable not allowed: %s' % cmd[0])
+            cmd = cmd[1:]
+    return cmd
+
+def _path_allowed(path, prefixes):
+    path = os.path.realpath(path)
+    return any(path.startswith(prefix) for prefix in prefixes)
+
+def _is_device(path):
+    """Whether path is a block device (or /dev/null)."""
+    path = os.path.realpath(path)
+    if path == os.devnull:
+        return True
+    try:
+        return (path.startswith('/dev/') and
+                stat.S_ISBLK(os.stat(path).st_mode))
+    except OSError:
+        return False
+
+def _get_wrapped(args):
+    """The command a wrapper (args[0]) runs."""
+    flags, options = WRAPPERS[args[0]]
+    args = args[1:]
+    while args and args[0].startswith('-'):
+        arg = args.pop(0)
+        if arg in flags:
+            continue
+        if arg in options and args:
+            args.pop(0)
+            continue
+        # e.g. ionice -c3
+        if not any(arg.startswith(opt) and len(arg) > len(opt)
+                   for opt in options):
+            raise ValueError('option not allowed: %s' % arg)
+    return args
+
+def _is_our_container(name):
+    return CONTAINER_TAG in name
+
+def _check_docker(args):
+    """Raise ValueError unless docker args (past 'docker') are allowed."""
+    if not args or not args[0] in DOCKER_SUBCOMMANDS:
+        raise ValueError('docker subcommand not allowed')
+
+    sub, args = args[0], args[1:]
+    if sub in ['inspect', 'ps']:
+        return
+
+    if sub in ['rm', 'stop']:
+        names = [arg for arg in args if not arg in ['-f']]
+        if not names or not all(_is_our_container(name) for name in names):
+            raise ValueError('container not allowed')
+        return
+
+    if sub == 'exec':
+        while args and args[0] in ['-i', '-t', '-it']:
+            args = args[1:]
+        if not args or not _is_our_container(args[0]):
+            raise ValueError('container not allowed')
+        check_command(args[1:], CONTAINER_COMMANDS)
+        return
+
+    # run
+    image = None
+    while args:
+        arg = args.pop(0)
+        if arg in ['-d', '-i', '-t', '-it', '--privileged']:
+            continue
+        if arg in ['--name', '-p'] and args:
+            value = args.pop(0)
+            if arg == '--name' and not _is_our_container(value):
+                raise ValueError('container not allowed')
+            continue
+        if arg == '-v' and args:
+            src = args.pop(0).split(':')[0]
+            if not (src in MOUNT_FILES or
+                    _path_allowed(src, MOUNT_PREFIXES)):
+                raise ValueError('mount not allowed: %s' % src)
+            continue
+        if arg.startswith('-') or image is not None:
+            raise ValueError('docker run argument not allowed: %s' % arg)
+        image = arg
+    if image is None or not image.startswith(CONTAINER_IMAGE_PREFIX):
+        raise ValueError('image not allowed')
+
+def check_command(cmd, extra_commands=()):
+    """Raise ValueError unless the helper may run cmd.
+
+       Commands run by wrappers (ionice, cgexec, env, docker exec) are
+       checked as well, like rootwrap's ChainingFilter.
+    """
+    try:
+        args = _get_command(cmd)
+    except ValueError as err:
+        raise ValueError('%s: %s' % (err, ' '.join(cmd)))
+    # a name only, never a path: it is looked up in EXEC_DIRS.
+    name = args[0] if args else ''
+    if not name in ALLOWED_COMMANDS and not name in extra_commands:
+        raise ValueError('command not allowed: %s' % ' '.join(cmd))
+
+    try:
+        if name in WRAPPERS:
+            check_command(_get_wrapped(args), extra_commands)
+        elif name == 'docker':
+            _check_docker(args[1:])
+        elif name == 'cat':
+            if not all(_path_allowed(path, READ_PREFIXES)
+                       for path in args[1:]):
+                raise ValueError('path not allowed')
+        elif name == 'tee':
+            if not all(_path_allowed(path, WRITE_PREFIXES)
+                       for path in args[1:] if not path.startswith('-')):
+                raise ValueError('path not allowed')
+        elif name == 'rm':
+            if not all(_path_allowed(path, REMOVE_PREFIXES) or path == '-f'
+                       for path in args[1:]):
+                raise ValueError('path not allowed')
+        elif name == 'dd':
+            if not all(_is_device(arg[len('of='):]) for arg in args[1:]
+                       if arg.startswith('of=')):
+                raise ValueError('dd may only write to block devices')
+        elif name in DEVICE_COMMANDS:
+            if not all(_is_device(path) for path in args[1:]
+                       if not path.startswith('-')):
+                raise ValueError('path not allowed')
+    except ValueError as err:
+        raise ValueError('%s: %s' % (err, ' '.join(cmd)))
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def _execute(self, request):
+        cmd = [str(arg) for arg in request['cmd']]
+        check_command(cmd)
+        process_input = request.get('process_input')
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    close_fds=True,
+                                    env={'PATH': ':'.join(EXEC_DIRS)})
+        except OSError as err:
+            return {'exit_code': 127, 'stdout': '', 'stderr': str(err)}
+        (out, err) = proc.communicate(process_input)
+        return {'exit_code': proc.returncode,
+                'stdout': out.decode('utf-8', 'replace'),
+                'stderr': err.decode('utf-8', 'replace')}
+
+    def _read(self, request):
+        path = request['path']
+        if not _path_allowed(path, READ_PREFIXES):
+            raise ValueError('path not allowed: %s' % path)
+        try:
+            with open(path) as f:
+                return {'data': f.read()}
+        except IOError as err:
+            return {'error': str(err)}
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                if request['op'] == 'execute':
+                    reply = self._execute(request)
+                elif request['op'] == 'read':
+                    reply = self._read(request)
+                else:
+                    raise ValueError('unknown op: %s' % request['op'])
+            except (ValueError, KeyError, TypeError) as err:
+                LOG.warning('[MRA] helper request rejected: %s' % err)
+                reply = {'rejected': str(err)}
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class HelperServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, user=None):
+    """Listen on path. The socket is made accessible to user only."""
+    if os.path.exists(path):
+        os.unlink(path)
+    server = HelperServer(path, _Handler)
+    if user is not None:
+        pw = pwd.getpwnam(user)
+        os.chown(path, pw.pw_uid, grp.getgrgid(pw.pw_gid).gr_gid)
+    os.chmod(path, 0o600)
+    LOG.info('[MRA] privileged helper listening on %s' % path)
+    server.serve_forever()
+
+
+class HelperClient(object):
+    """Sends requests to the helper over reused connections."""
+
+    def __init__(self, path):
+        self.path = path
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock, sock.makefile('rb'), sock.makefile('wb')
+
+    def _call(self, request):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+
+        while True:
+            # a kept connection may have been closed by a restarted
+            # helper; such a failure is retried on a new connection.
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+            sock, rfile, wfile = conn
+            try:
+                wfile.write(json.dumps(request) + '\n')
+                wfile.flush()
+                line = rfile.readline()
+                if not line:
+                    raise socket.error('helper closed the connection')
+                reply = json.loads(line)
+                break
+            except (socket.error, IOError):
+                sock.close()
+                conn = None
+                if not reused:
+                    raise
+
+        with self._lock:
+            self._idle.append(conn)
+
+        if 'rejected' in reply:
+            raise putils.ProcessExecutionError(
+                stderr=reply['rejected'], exit_code=-1,
+                cmd=' '.join(request.get('cmd', [request.get('path', '')])),
+                description='Rejected by the privileged helper')
+        return reply
+
+    def execute(self, *cmd, **kwargs):
+        """processutils.execute() through the helper."""
+        cmd = [str(arg) for arg in cmd]
+        check_exit_code = kwargs.get('check_exit_code', True)
+        if isinstance(check_exit_code, bool):
+            ignore_exit_code = not check_exit_code
+            check_exit_code = [0]
+        else:
+            ignore_exit_code = False
+            if isinstance(check_exit_code, int):
+                check_exit_code = [check_exit_code]
+
+        reply = self._call({'op': 'execute', 'cmd': cmd,
+                            'process_input': kwargs.get('process_input')})
+
+        if (not ignore_exit_code and
+                not reply['exit_code'] in check_exit_code):
+            raise putils.ProcessExecutionError(
+                exit_code=reply['exit_code'], stdout=reply['stdout'],
+                stderr=reply['stderr'], cmd=' '.join(cmd))
+        return reply['stdout'], reply['stderr']
+
+    def read(self, path):
+        reply = self._call({'op': 'read', 'path': path})
+        if 'error' in reply:
+            raise IOError(reply['error'])
+        return reply['data']
+
+
+def configure(socket_path):
+    """Use the helper at socket_path. (None: the root helper)"""
+    global _socket_path, _client
+    _socket_path = socket_path
+    _client = HelperClient(socket_path) if socket_path else None
+
+def get_client():
+    return _client
+
+def execute(*cmd, **kwargs):
+    """processutils.execute(), through the helper for root commands."""
+    if _client is None or not kwargs.get('run_as_root'):
+        return putils.execute(*cmd, **kwargs)
+    return _client.execute(*cmd, **kwargs)
+
+def read_file(path, root_helper=None):
+    """Read a sysfs/procfs file, as root if this process can not."""
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        if _client is not None:
+            return _client.read(path)
+        (out, _err) = putils.execute('cat', path,
+                                     root_helper=root_helper,
+                                     run_as_root=True)
+        return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='IOArbiter privileged helper')
+    parser.add_argument('--socket', default='/var/run/cinder/ioarb-helper.sock')
+    parser.add_argument('--user', default='cinder',
+                        help='user allowed to connect')
+    args = parser.parse_args()
+    serve(args.socket, args.user)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#    Copyright (c) 2015 AT&T Labs Research
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#    Author: Moo-Ryong Ra, mra@research.att.com
+
+"""Block device inventory cache
+
+   Device attributes (size, rotational, model, vendor) are read from
+   sysfs in-process and kept until something may have changed. A change
+   is detected by the signature of a few directories:
+
+     - /sys/block        devices added or removed
+     - /run/udev/data    udev rewrites a device's entry on every event,
+                         e.g. when it becomes a PV or an md member
+     - /dev              device nodes created or removed
+
+   plus a generation counter bumped by invalidate(), which the code that
+   changes devices (mdadm, vgcreate, ..) calls. Entries are also dropped
+   after max_age seconds, in case an event goes unnoticed.
+
+   Other per-device results that depend on the same state (e.g. which
+   devices are in use) can be kept with lookup().
+"""
+
+import os
+import time
+
+from oslo_log import log as logging
+
+from cinder.brick.local_dev import ioarbhelper
+
+LOG = logging.getLogger(__name__)
+
+SYSFS_BLOCK = '/sys/block'
+WATCHED_DIRS = [SYSFS_BLOCK, '/run/udev/data', '/dev']
+DEFAULT_MAX_AGE = 300
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class DeviceInventory(object):
+    """Cached block device information."""
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        self._generation = 0
+        self._signature = None
+        self._loaded_at = 0
+        self._devices = {}
+        self._results = {}
+
+    def get_signature(self):
+        return (self._generation,
+                tuple(_mtime(path) for path in WATCHED_DIRS))
+
+    def invalidate(self):
+        """Drop everything. Call after changing devices."""
+        self._generation += 1
+
+    def _check(self):
+        signature = self.get_signature()
+        now = time.time()
+        if (signature != self._signature or
+                now - self._loaded_at > self.max_age):
+            if self._signature is not None:
+                LOG.debug('[MRA] device inventory is refreshed.')
+            self._devices = {}
+            self._results = {}
+            self._signature = signature
+            self._loaded_at = now
+
+    def _load(self, root_helper, dev):
+        devdir = os.path.join(SYSFS_BLOCK, dev)
+        devinfo = {'dev': dev}
+
+        out = ioarbhelper.read_file(os.path.join(devdir, 'size'),
+                                    root_helper)
+        if out is not None:
+            devinfo['size'] = round(float(out.split()[0]) * 512
+                                    / pow(1024, 3), 2)
+
+        out = ioarbhelper.read_file(
+            os.path.join(devdir, 'queue', 'rotational'), root_helper)
+        if out is not None:
+            devinfo['type'] = out.split()[0]
+
+        out = ioarbhelper.read_file(
+            os.path.join(devdir, 'device', 'model'), root_helper)
+        if out is not None:
+            devinfo['model'] = out.strip()
+
+        out = ioarbhelper.read_file(
+            os.path.join(devdir, 'device', 'vendor'), root_helper)
+        if out is not None:
+            devinfo['vendor'] = out.strip()
+
+        return devinfo
+
+    def get_device(self, root_helper, dev):
+        """Information of a device. (name without /dev/)"""
+        self._check()
+        if not dev in self._devices:
+            self._devices[dev] = self._load(root_helper, dev)
+        return dict(self._devices[dev])
+
+    def lookup(self, key, loader):
+        """Result of loader(), kept while the devices are unchanged."""
+        self._check()
+        if not key in self._results:
+            self._results[key] = loader()
+        return self._results[key]
+
+
+_inventory = DeviceInventory()
+
+def get_inventory():
+    return _inventory
+
+def invalidate():
+    _inventory.invalidate()
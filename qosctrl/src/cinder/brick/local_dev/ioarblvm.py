@@ -21,31 +21,210 @@
 LVM class for performing LVM operations.
 """
 
+import functools
 import itertools
+import json
 import math
 import os
 import re
+import threading
+import time
 
+import eventlet
 from oslo_concurrency import processutils as putils
 from oslo_log import log as logging
 from oslo_utils import excutils
 
 from cinder.brick import exception
 from cinder.brick import executor
-from cinder.i18n import _, _LE, _LI
+from cinder.brick.local_dev import ioarbhelper
+from cinder.brick.local_dev import ioarbinventory
+from cinder.i18n import _, _LE, _LI, _LW
 from cinder import utils
 
 
 LOG = logging.getLogger(__name__)
 
+# md indices handed out by allocate_md_index(), not created yet.
+_md_reserved = set()
+_md_lock = threading.Lock()
+
+# How many md indices create_software_raid() tries when another
+# process takes the one it picked.
+MD_CREATE_RETRIES = 5
+
+
+def _invalidates_metadata(func):
+    """Drop the cached LVM metadata after func, which changes it."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            LVM.invalidate_metadata()
+    return wrapper
+
+
+class LVMSnapshot(object):
+    """VGs, LVs and PVs of the system as of one LVM report.
+
+       Queries of LVM take a snapshot=None argument: with a snapshot,
+       they are answered from it instead of running an LVM command.
+       Take one for the length of one operation or stats cycle; it
+       does not see later changes.
+    """
+
+    VG_FIELDS = 'vg_name,vg_size,vg_free,lv_count,vg_uuid'
+    LV_FIELDS = 'lv_name,lv_size,lv_attr'
+    PV_FIELDS = 'pv_name,pv_size,pv_free'
+
+    # 'lvm fullreport' with JSON output came with LVM 2.02.158.
+    FULLREPORT_VERSION = (2, 2, 158)
+
+    # None: not probed yet. Probed once per process.
+    _supports_fullreport = None
+
+    def __init__(self, vgs, lvs, pvs):
+        self.vgs = vgs
+        self.lvs = lvs
+        self.pvs = pvs
+
+    @staticmethod
+    def load(root_helper, execute=None):
+        """Take a snapshot with 'lvm fullreport', or with one pvs and
+           one lvs on LVM versions without JSON reports.
+        """
+        execute = execute or ioarbhelper.execute
+        if LVMSnapshot.supports_fullreport(root_helper):
+            try:
+                return LVMSnapshot._load_fullreport(root_helper, execute)
+            except (putils.ProcessExecutionError, ValueError,
+                    KeyError) as err:
+                # e.g. no rootwrap filter for 'lvm'. not tried again.
+                LOG.warning(_LW('[MRA] lvm fullreport is not available, '
+                                'using pvs and lvs: %s') % err)
+                LVMSnapshot._supports_fullreport = False
+        return LVMSnapshot._load_reports(root_helper, execute)
+
+    @staticmethod
+    def supports_fullreport(root_helper):
+        """Whether LVM has JSON fullreport. (checked once)"""
+        if LVMSnapshot._supports_fullreport is None:
+            LVMSnapshot._supports_fullreport = (
+                LVM.get_lvm_version(root_helper) >=
+                LVMSnapshot.FULLREPORT_VERSION)
+        return LVMSnapshot._supports_fullreport
+
+    @staticmethod
+    def _load_fullreport(root_helper, execute):
+        cmd = LVM.LVM_CMD_PREFIX + ['lvm', 'fullreport',
+                                    '--reportformat', 'json',
+                                    '--units', 'g', '--nosuffix',
+                                    '--configreport', 'vg',
+                                    '-o', LVMSnapshot.VG_FIELDS,
+                                    '--configreport', 'lv',
+                                    '-o', LVMSnapshot.LV_FIELDS,
+                                    '--configreport', 'pv',
+                                    '-o', LVMSnapshot.PV_FIELDS]
+        (out, _err) = execute(*cmd, root_helper=root_helper,
+                              run_as_root=True)
+
+        # one report per VG. orphan PVs come in one without a VG.
+        vgs, lvs, pvs = [], [], []
+        for report in json.loads(out)['report']:
+            vg_name = ''
+            for vg in report.get('vg', []):
+                vg_name = vg['vg_name']
+                vgs.append({'name': vg_name,
+                            'size': float(vg['vg_size']),
+                            'available': float(vg['vg_free']),
+                            'lv_count': int(vg['lv_count']),
+                            'uuid': vg['vg_uuid']})
+            for lv in report.get('lv', []):
+                lvs.append({'vg': vg_name,
+                            'name': lv['lv_name'],
+                            'size': lv['lv_size'],
+                            'attr': lv['lv_attr']})
+            for pv in report.get('pv', []):
+                pvs.append({'vg': vg_name,
+                            'name': pv['pv_name'],
+                            'size': float(pv['pv_size']),
+                            'available': float(pv['pv_free'])})
+
+        return LVMSnapshot(vgs, lvs, pvs)
+
+    @staticmethod
+    def _load_reports(root_helper, execute):
+        field_sep = '|'
+
+        # VGs come along with their PVs.
+        cmd = LVM.LVM_CMD_PREFIX + ['pvs', '--noheadings', '--unit=g',
+                                    '--nosuffix', '--separator', field_sep,
+                                    '-o', LVMSnapshot.PV_FIELDS + ',' +
+                                    LVMSnapshot.VG_FIELDS]
+        (out, _err) = execute(*cmd, root_helper=root_helper,
+                              run_as_root=True)
+        vgs, pvs = {}, []
+        for line in (out or '').split('\n'):
+            fields = [field.strip() for field in line.split(field_sep)]
+            if len(fields) != 8:
+                continue
+            pvs.append({'vg': fields[3],
+                        'name': fields[0],
+                        'size': float(fields[1]),
+                        'available': float(fields[2])})
+            if fields[3]:
+                vgs[fields[3]] = {'name': fields[3],
+                                  'size': float(fields[4]),
+                                  'available': float(fields[5]),
+                                  'lv_count': int(fields[6]),
+                                  'uuid': fields[7]}
+
+        cmd = LVM.LVM_CMD_PREFIX + ['lvs', '--noheadings', '--unit=g',
+                                    '--nosuffix', '--separator', field_sep,
+                                    '-o', 'vg_name,' + LVMSnapshot.LV_FIELDS]
+        (out, _err) = execute(*cmd, root_helper=root_helper,
+                              run_as_root=True)
+        lvs = []
+        for line in (out or '').split('\n'):
+            fields = [field.strip() for field in line.split(field_sep)]
+            if len(fields) != 4:
+                continue
+            lvs.append({'vg': fields[0],
+                        'name': fields[1],
+                        'size': fields[2],
+                        'attr': fields[3]})
+
+        return LVMSnapshot(vgs.values(), lvs, pvs)
+
+    def get_vgs(self, vg_name=None):
+        return [dict(vg) for vg in self.vgs
+                if vg_name is None or vg['name'] == vg_name]
+
+    def get_lvs(self, vg_name=None, lv_name=None):
+        return [dict(lv) for lv in self.lvs
+                if (vg_name is None or lv['vg'] == vg_name) and
+                   (lv_name is None or lv['name'] == lv_name)]
+
+    def get_pvs(self, vg_name=None):
+        return [dict(pv) for pv in self.pvs
+                if vg_name is None or pv['vg'] == vg_name]
+
 
 class LVM(executor.Executor):
     """LVM object to enable various LVM related operations."""
     LVM_CMD_PREFIX = ['env', 'LC_ALL=C']
 
+    # VG/LV/PV metadata shared by the LVM objects of this process, kept
+    # for METADATA_TTL seconds (0: not kept). See get_metadata().
+    METADATA_TTL = 5
+    _metadata = None
+    _metadata_time = 0
+    _metadata_generation = 0
+
     def __init__(self, vg_name, root_helper, create_vg=False,
                  physical_volumes=None, lvm_type='default',
-                 executor=putils.execute, lvm_conf=None):
+                 executor=ioarbhelper.execute, lvm_conf=None):
 
         """Initialize the LVM object.
 
@@ -95,7 +274,9 @@ class LVM(executor.Executor):
                     LOG.error(_LE('StdErr  :%s') % err.stderr)
                     raise exception.VolumeGroupCreationFailed(vg_name=self.vg_name)
 
-        if self._vg_exists() is False:
+        # one LVM scan answers the checks below.
+        snapshot = LVMSnapshot.load(root_helper, execute=self._execute)
+        if self._vg_exists(snapshot=snapshot) is False:
             LOG.error(_LE('Unable to locate Volume Group %s') % vg_name)
             raise exception.VolumeGroupNotFound(vg_name=vg_name)
 
@@ -103,7 +284,7 @@ class LVM(executor.Executor):
 
         if lvm_type == 'thin':
             pool_name = "%s-pool" % self.vg_name
-            if self.get_volume(pool_name) is None:
+            if self.get_volume(pool_name, snapshot=snapshot) is None:
                 try:
                     self.create_thin_pool(pool_name)
                 except putils.ProcessExecutionError:
@@ -115,18 +296,52 @@ class LVM(executor.Executor):
 
             self.vg_thin_pool = pool_name
             self.activate_lv(self.vg_thin_pool)
-        self.pv_list = self.get_all_physical_volumes(root_helper, vg_name)
+        self.pv_list = self.get_all_physical_volumes(root_helper, vg_name,
+                                                     snapshot=snapshot)
         if lvm_conf and os.path.isfile(lvm_conf):
             LVM.LVM_CMD_PREFIX = ['env',
                                   'LC_ALL=C',
                                   'LVM_SYSTEM_DIR=/etc/cinder']
 
-    def _vg_exists(self):
+    def get_metadata(self):
+        """An LVMSnapshot to answer queries of this object from.
+
+           A snapshot younger than METADATA_TTL is reused. Methods that
+           change LVM metadata drop it, so an object always sees its own
+           changes; changes made elsewhere show up within the TTL.
+           None if caching is off.
+        """
+        if LVM.METADATA_TTL <= 0:
+            return None
+
+        if (LVM._metadata is None or
+                time.time() - LVM._metadata_time > LVM.METADATA_TTL):
+            generation = LVM._metadata_generation
+            loaded_at = time.time()
+            snapshot = LVMSnapshot.load(self._root_helper,
+                                        execute=self._execute)
+            if generation != LVM._metadata_generation:
+                # changed while loading.
+                return snapshot
+            LVM._metadata = snapshot
+            LVM._metadata_time = loaded_at
+
+        return LVM._metadata
+
+    @staticmethod
+    def invalidate_metadata():
+        LVM._metadata = None
+        LVM._metadata_generation += 1
+
+    def _vg_exists(self, snapshot=None):
         """Simple check to see if VG exists.
 
         :returns: True if vg specified in object exists, else False
 
         """
+        if snapshot is not None:
+            return len(snapshot.get_vgs(self.vg_name)) > 0
+
         exists = False
         cmd = LVM.LVM_CMD_PREFIX + ['vgs', '--noheadings',
                                     '-o', 'name', self.vg_name]
@@ -141,9 +356,14 @@ class LVM(executor.Executor):
 
         return exists
 
+    @_invalidates_metadata
     def _create_vg(self, pv_list):
         cmd = ['vgcreate', self.vg_name, ','.join(pv_list), '-y']
-        self._execute(*cmd, root_helper=self._root_helper, run_as_root=True)
+        try:
+            self._execute(*cmd, root_helper=self._root_helper,
+                          run_as_root=True)
+        finally:
+            ioarbinventory.invalidate()
 
     def _get_vg_uuid(self):
         cmd = LVM.LVM_CMD_PREFIX + ['vgs', '--noheadings',
@@ -205,56 +425,23 @@ class LVM(executor.Executor):
            c) type: /sys/block/<dev>/queue/rotational 0: ssd, 1: hdd
            d) model: /sys/block/<dev>/device/model
            e) vendor: /sys/block/<dev>/device/vendor
+           They are read in-process and cached. (see ioarbinventory)
         """
         
-        data = []
+        inventory = ioarbinventory.get_inventory()
         devitr = devlist.replace('/dev/','').split(',')
-        for dev in devitr:
-            devinfo = {'dev': dev}
-
-            # size
-            cmd = ['cat', '/sys/block/%s/size' % dev]
-            (out, _err) = putils.execute(*cmd, 
-                                         root_helper=root_helper, 
-                                         run_as_root=True)
-            if out is not None:
-                devinfo['size'] = round(float(out.split()[0]) * 512 / pow(1024, 3), 2)
-
-            # type
-            cmd = ['cat', '/sys/block/%s/queue/rotational' % dev]
-            (out, _err) = putils.execute(*cmd, 
-                                         root_helper=root_helper, 
-                                         run_as_root=True)
-            if out is not None:
-                devinfo['type'] = out.split()[0]
-
-            # model
-            cmd = ['cat', '/sys/block/%s/device/model' % dev]
-            (out, _err) = putils.execute(*cmd, 
-                                         root_helper=root_helper, 
-                                         run_as_root=True)
-            if out is not None:
-                devinfo['model'] = out.split()[0]
-
-            # vendor
-            cmd = ['cat', '/sys/block/%s/device/vendor' % dev]
-            (out, _err) = putils.execute(*cmd, 
-                                         root_helper=root_helper, 
-                                         run_as_root=True)
-            if out is not None:
-                devinfo['vendor'] = out.split()[0]
-
-            # aggregate information
-            data.append(devinfo)
-
-        return data
+        return [inventory.get_device(root_helper, dev) for dev in devitr]
 
 
     @staticmethod
-    def get_lvcnt_by_vgname(root_helper, vgname):
+    def get_lvcnt_by_vgname(root_helper, vgname, snapshot=None):
+        if snapshot is not None:
+            vgs = snapshot.get_vgs(vgname)
+            return vgs[0]['lv_count'] if vgs else 0
+
         cmd = LVM.LVM_CMD_PREFIX + ['vgs', '--noheadings',
                                     '-o', 'lv_count', vgname]
-        (out, _err) = putils.execute(*cmd,
+        (out, _err) = ioarbhelper.execute(*cmd,
                                     root_helper=root_helper,
                                     run_as_root=True)
         if out is not None:
@@ -273,7 +460,7 @@ class LVM(executor.Executor):
         """
 
         cmd = LVM.LVM_CMD_PREFIX + ['vgs', '--version']
-        (out, _err) = putils.execute(*cmd,
+        (out, _err) = ioarbhelper.execute(*cmd,
                                      root_helper=root_helper,
                                      run_as_root=True)
         lines = out.split('\n')
@@ -335,15 +522,21 @@ class LVM(executor.Executor):
         return self._supports_lvchange_ignoreskipactivation
 
     @staticmethod
-    def get_lv_info(root_helper, vg_name=None, lv_name=None):
+    def get_lv_info(root_helper, vg_name=None, lv_name=None, snapshot=None):
         """Retrieve info about LVs (all, in a VG, or a single LV).
 
         :param root_helper: root_helper to use for execute
         :param vg_name: optional, gathers info for only the specified VG
         :param lv_name: optional, gathers info for only the specified LV
+        :param snapshot: optional, an LVMSnapshot to answer from
         :returns: List of Dictionaries with LV info
 
         """
+        if snapshot is not None:
+            if vg_name is None:
+                lv_name = None
+            return [{'vg': lv['vg'], 'name': lv['name'], 'size': lv['size']}
+                    for lv in snapshot.get_lvs(vg_name, lv_name)]
 
         cmd = LVM.LVM_CMD_PREFIX + ['lvs', '--noheadings', '--unit=g',
                                     '-o', 'vg_name,name,size', '--nosuffix']
@@ -353,7 +546,7 @@ class LVM(executor.Executor):
             cmd.append(vg_name)
 
         try:
-            (out, _err) = putils.execute(*cmd,
+            (out, _err) = ioarbhelper.execute(*cmd,
                                          root_helper=root_helper,
                                          run_as_root=True)
         except putils.ProcessExecutionError as err:
@@ -373,44 +566,51 @@ class LVM(executor.Executor):
 
         return lv_list
 
-    def get_volumes(self, lv_name=None):
+    def get_volumes(self, lv_name=None, snapshot=None):
         """Get all LV's associated with this instantiation (VG).
 
         :returns: List of Dictionaries with LV info
 
         """
+        if snapshot is None:
+            snapshot = self.get_metadata()
         return self.get_lv_info(self._root_helper,
                                 self.vg_name,
-                                lv_name)
+                                lv_name,
+                                snapshot=snapshot)
 
-    def get_volume(self, name):
+    def get_volume(self, name, snapshot=None):
         """Get reference object of volume specified by name.
 
         :returns: dict representation of Logical Volume if exists
 
         """
-        ref_list = self.get_volumes(name)
+        ref_list = self.get_volumes(name, snapshot=snapshot)
         for r in ref_list:
             if r['name'] == name:
                 return r
         return None
 
     @staticmethod
-    def get_all_physical_volumes(root_helper, vg_name=None):
+    def get_all_physical_volumes(root_helper, vg_name=None, snapshot=None):
         """Static method to get all PVs on a system.
 
         :param root_helper: root_helper to use for execute
         :param vg_name: optional, gathers info for only the specified VG
+        :param snapshot: optional, an LVMSnapshot to answer from
         :returns: List of Dictionaries with PV info
 
         """
+        if snapshot is not None:
+            return snapshot.get_pvs(vg_name)
+
         field_sep = '|'
         cmd = LVM.LVM_CMD_PREFIX + ['pvs', '--noheadings',
                                     '--unit=g',
                                     '-o', 'vg_name,name,size,free',
                                     '--separator', field_sep,
                                     '--nosuffix']
-        (out, _err) = putils.execute(*cmd,
+        (out, _err) = ioarbhelper.execute(*cmd,
                                      root_helper=root_helper,
                                      run_as_root=True)
 
@@ -427,25 +627,32 @@ class LVM(executor.Executor):
                             'available': float(fields[3])})
         return pv_list
 
-    def get_physical_volumes(self):
+    def get_physical_volumes(self, snapshot=None):
         """Get all PVs associated with this instantiation (VG).
 
         :returns: List of Dictionaries with PV info
 
         """
+        if snapshot is None:
+            snapshot = self.get_metadata()
         self.pv_list = self.get_all_physical_volumes(self._root_helper,
-                                                     self.vg_name)
+                                                     self.vg_name,
+                                                     snapshot=snapshot)
         return self.pv_list
 
     @staticmethod
-    def get_all_volume_groups(root_helper, vg_name=None):
+    def get_all_volume_groups(root_helper, vg_name=None, snapshot=None):
         """Static method to get all VGs on a system.
 
         :param root_helper: root_helper to use for execute
         :param vg_name: optional, gathers info for only the specified VG
+        :param snapshot: optional, an LVMSnapshot to answer from
         :returns: List of Dictionaries with VG info
 
         """
+        if snapshot is not None:
+            return snapshot.get_vgs(vg_name)
+
         cmd = LVM.LVM_CMD_PREFIX + ['vgs', '--noheadings',
                                     '--unit=g', '-o',
                                     'name,size,free,lv_count,uuid',
@@ -454,7 +661,7 @@ class LVM(executor.Executor):
         if vg_name is not None:
             cmd.append(vg_name)
 
-        (out, _err) = putils.execute(*cmd,
+        (out, _err) = ioarbhelper.execute(*cmd,
                                      root_helper=root_helper,
                                      run_as_root=True)
         vg_list = []
@@ -470,7 +677,7 @@ class LVM(executor.Executor):
 
         return vg_list
 
-    def update_volume_group_info(self):
+    def update_volume_group_info(self, snapshot=None):
         """Update VG info for this instantiation.
 
         Used to update member fields of object and
@@ -479,7 +686,10 @@ class LVM(executor.Executor):
         :returns: Dictionaries of VG info
 
         """
-        vg_list = self.get_all_volume_groups(self._root_helper, self.vg_name)
+        if snapshot is None:
+            snapshot = self.get_metadata()
+        vg_list = self.get_all_volume_groups(self._root_helper, self.vg_name,
+                                             snapshot=snapshot)
 
         if len(vg_list) != 1:
             LOG.error(_LE('Unable to find VG: %s') % self.vg_name)
@@ -515,7 +725,8 @@ class LVM(executor.Executor):
             # therefore we should provide only self.vg_name, but not
             # self.vg_thin_pool here.
             for lv in self.get_lv_info(self._root_helper,
-                                       self.vg_name):
+                                       self.vg_name,
+                                       snapshot=snapshot):
                 lvsize = lv['size']
                 # get_lv_info runs "lvs" command with "--nosuffix".
                 # This removes "g" from "1.00g" and only outputs "1.00".
@@ -555,6 +766,7 @@ class LVM(executor.Executor):
         # leave 5% free for metadata
         return "%sg" % (self.vg_free_space * 0.95)
 
+    @_invalidates_metadata
     def create_thin_pool(self, name=None, size_str=None):
         """Creates a thin provisioning pool for this VG.
 
@@ -595,74 +807,106 @@ class LVM(executor.Executor):
         self.vg_thin_pool = name
         return size_str
 
+    @staticmethod
+    def get_blkdevs_in_use(root_helper):
+        """Kernel names of the block devices in use, and why.
+
+           One snapshot of
+               - LVM pvs (pvs)
+               - md array members (/sys/block/md*/md/dev-*, /proc/mdstat)
+               - holders (/sys/block/*/holders, e.g. dm and md devices)
+               - mounts (/proc/mounts)
+           A disk is in use if it or one of its partitions is.
+           Returns {name: reason}, e.g. {'sdb': 'pv', 'sdc': 'md'}.
+        """
+        sysfs = ioarbinventory.SYSFS_BLOCK
+        used = {}
+
+        def _mark(path, reason):
+            name = os.path.basename(os.path.realpath(path))
+            used.setdefault(name, reason)
+
+        for pv in LVM.get_all_physical_volumes(root_helper):
+            _mark(pv['name'], 'pv')
+
+        for dev in os.listdir(sysfs):
+            if dev.startswith('md'):
+                mddir = os.path.join(sysfs, dev, 'md')
+                if os.path.isdir(mddir):
+                    for member in os.listdir(mddir):
+                        if member.startswith('dev-'):
+                            used.setdefault(member[4:], 'md')
+
+            # the disk itself and its partitions.
+            devdir = os.path.join(sysfs, dev)
+            for part in [dev] + [part for part in os.listdir(devdir)
+                                 if part.startswith(dev)]:
+                partdir = devdir if part == dev else os.path.join(devdir, part)
+                holders = os.path.join(partdir, 'holders')
+                if os.path.isdir(holders) and os.listdir(holders):
+                    used.setdefault(part, 'holder')
+
+        # arrays sysfs does not show. (e.g. inactive ones)
+        try:
+            with open('/proc/mdstat') as f:
+                mdstat = f.readlines()
+        except IOError:
+            # md is not loaded.
+            mdstat = []
+        for line in mdstat:
+            fields = line.split()
+            if len(fields) > 2 and fields[0].startswith('md'):
+                for field in fields[2:]:
+                    match = re.match(r'^([^\[\s]+)\[\d+\]', field)
+                    if match:
+                        used.setdefault(match.group(1), 'md')
+
+        with open('/proc/mounts') as f:
+            for line in f:
+                source = line.split()[0] if line.strip() else ''
+                if source.startswith('/dev/'):
+                    _mark(source, 'mount')
+
+        # partitions make their disks in use.
+        for dev in os.listdir(sysfs):
+            devdir = os.path.join(sysfs, dev)
+            for part in os.listdir(devdir):
+                if (part.startswith(dev) and part in used and
+                        os.path.exists(os.path.join(devdir, part,
+                                                    'partition'))):
+                    used.setdefault(dev, used[part])
+
+        return used
+
     @staticmethod
     def filter_blkdev_in_use(root_helper, blkdev):
         """Filter out block devices in use
            blkdev: list of devices.
-           In this function, we check only two cases.
-               - can be part of an active LVM pv. (pvs)
-               - can be part of a raid group. (/proc/mdstat)
-           This is not comprehensive, so there could be other cases.
+           Devices are checked by their exact kernel names against one
+           snapshot from get_blkdevs_in_use(). This is not
+           comprehensive, so there could be other cases.
         """
-        retdevs = []
-        lvmpvs = LVM.get_all_physical_volumes(root_helper)
+        used = LVM.get_blkdevs_in_use(root_helper)
 
+        retdevs = []
         for dev in blkdev:
-            # check if it is in LVM pv.
-            in_use = False
-            for pv in lvmpvs:
-                if dev in pv['name']:
-                    LOG.debug('[MRA] [%(dev)s] presents in LVM pv.' % {'dev': dev})
-                    in_use = True
-                    break
-            if in_use: continue 
-
-            # check if it is used by mdadm.
-            cmd = ['cat', '/proc/mdstat']
-            try:
-                (out, _err) = putils.execute(*cmd,
-                                             root_helper=root_helper,
-                                             run_as_root=True)
-                #LOG.debug('[MRA] mdstat out: %(out)s' % {'out': out})
-            except putils.ProcessExecutionError as err:
-                LOG.exception(_LE('Error in checking block device.'))
-                LOG.error(_LE('Cmd     :%s') % err.cmd)
-                LOG.error(_LE('StdOut  :%s') % err.stdout)
-                LOG.error(_LE('StdErr  :%s') % err.stderr)
+            name = os.path.basename(os.path.realpath(dev))
+            if name in used:
+                LOG.debug('[MRA] [%(dev)s] is in use. (%(why)s)'
+                          % {'dev': dev, 'why': used[name]})
                 continue
-
-            lines = out.split('\n')
-            in_use = False
-            for line in lines:
-                if dev.split('/')[2] in line:
-                    LOG.debug('[MRA] [%(dev)s] presents in /proc/mdstat.' % {'dev': dev})
-                    in_use = True
-                    break
-            if not in_use:
-                retdevs.append(dev)
+            retdevs.append(dev)
 
         return retdevs
 
     @staticmethod
-    def create_software_raid(root_helper, stspec):
-        """Create a software RAID"""
-
-        # choose block devices to use.
-        ndisk = int(stspec['ndisk'])
-        devlist = stspec['phydevs'].split(',')[0:ndisk]
-        ndisk = len(devlist)
-
-        # if available device is just one, no need to create an array.
-        if ndisk == 1:
-            return devlist[0]
-
-        # decide an array name.
+    def get_md_indices(root_helper):
+        """Indices of the md arrays in /proc/mdstat."""
         cmd = ['cat', '/proc/mdstat']
         try:
-            (out, _err) = putils.execute(*cmd,
+            (out, _err) = ioarbhelper.execute(*cmd,
                                          root_helper=root_helper,
                                          run_as_root=True)
-            #LOG.debug('[MRA] mdstat out: %(out)s' % {'out': out})
         except putils.ProcessExecutionError as err:
             LOG.exception(_LE('Error in checking raid array info.'))
             LOG.error(_LE('Cmd     :%s') % err.cmd)
@@ -670,53 +914,131 @@ class LVM(executor.Executor):
             LOG.error(_LE('StdErr  :%s') % err.stderr)
             raise
 
-        lines = out.split('\n')
-        idx = 0
-        for line in lines:
+        indices = set()
+        for line in out.split('\n'):
             arrname = line.split()[0] if len(line.split()) > 0 else None
-            #parsed = line.split()
-            #if len(parsed) > 0:
-            #    arrname = parsed[0]
-            if arrname is not None and arrname.startswith('md'):
-                arridx = int(arrname[2:])
-                idx = arridx+1 if arridx >= idx else idx
+            if arrname is not None and re.match(r'^md\d+$', arrname):
+                indices.add(int(arrname[2:]))
 
-        array_name = '/dev/md' + str(idx)
+        return indices
 
-        # making a command
-        cmd = ['mdadm', '--create', array_name, '--run', '--assume-clean']
+    @staticmethod
+    def allocate_md_index(root_helper):
+        """Reserve an md index no array uses.
+
+           Indices reserved here are not handed out again until they
+           are released with release_md_index(), so concurrent callers
+           in this process never pick the same one. Arrays being
+           assembled by others are skipped by their /sys/block entry.
+        """
+        with _md_lock:
+            used = LVM.get_md_indices(root_helper) | _md_reserved
+            idx = max(used) + 1 if used else 0
+            while os.path.exists('/sys/block/md%d' % idx):
+                idx += 1
+            _md_reserved.add(idx)
+
+        return idx
+
+    @staticmethod
+    def release_md_index(idx):
+        _md_reserved.discard(idx)
+
+    @staticmethod
+    def create_software_raid(root_helper, stspec):
+        """Create a software RAID"""
+
+        # choose block devices to use.
+        ndisk = int(stspec['ndisk'])
+        devlist = stspec['phydevs'].split(',')[0:ndisk]
+        ndisk = len(devlist)
+
+        # if available device is just one, no need to create an array.
+        if ndisk == 1:
+            return devlist[0]
 
         raidconf = stspec['raidconf']
         if raidconf == "jbod":
-            cmd.extend(['--level', 'linear', '--raid-devices', ndisk])
+            level = 'linear'
         elif raidconf == "raid0":
-            cmd.extend(['--level', 'stripe', '--raid-devices', ndisk])
+            level = 'stripe'
         elif raidconf == "raid1":
-            cmd.extend(['--level', 'mirror', '--raid-devices', ndisk])
+            level = 'mirror'
         elif raidconf == "raid5":
-            cmd.extend(['--level', '5', '--raid-devices', ndisk])
+            level = '5'
         elif raidconf == "raid6":
-            cmd.extend(['--level', '6', '--raid-devices', ndisk])
+            level = '6'
         else:
             LOG.error("[MRA] unknown software raid configuration: %s" % stspec['raidconf'])
             raise
 
-        for dev in devlist:
-            cmd.extend([dev])
+        for attempt in range(MD_CREATE_RETRIES):
+            # decide an array name.
+            idx = LVM.allocate_md_index(root_helper)
+            array_name = '/dev/md' + str(idx)
 
-        # execute mdadm commands.
-        try:
-            (out, _err) = putils.execute(*cmd,
-                                         root_helper=root_helper,
-                                         run_as_root=True)
-        except putils.ProcessExecutionError as err:
-            LOG.exception(_LE('Error creating Software RAID'))
-            LOG.error(_LE('Cmd     :%s') % err.cmd)
-            LOG.error(_LE('StdOut  :%s') % err.stdout)
-            LOG.error(_LE('StdErr  :%s') % err.stderr)
-            raise
+            # making a command
+            cmd = ['mdadm', '--create', array_name, '--run', '--assume-clean',
+                   '--level', level, '--raid-devices', ndisk]
+            cmd.extend(devlist)
+
+            # execute mdadm commands.
+            try:
+                (out, _err) = ioarbhelper.execute(*cmd,
+                                             root_helper=root_helper,
+                                             run_as_root=True)
+            except putils.ProcessExecutionError as err:
+                if (attempt + 1 < MD_CREATE_RETRIES and
+                        idx in LVM.get_md_indices(root_helper)):
+                    # another process has taken the index.
+                    LOG.debug('[MRA] %s is taken. retrying.' % array_name)
+                    continue
+                LOG.exception(_LE('Error creating Software RAID'))
+                LOG.error(_LE('Cmd     :%s') % err.cmd)
+                LOG.error(_LE('StdOut  :%s') % err.stdout)
+                LOG.error(_LE('StdErr  :%s') % err.stderr)
+                raise
+            finally:
+                LVM.release_md_index(idx)
+                ioarbinventory.invalidate()
 
-        return array_name
+            return array_name
+
+    @staticmethod
+    def create_software_raids(root_helper, stspecs, workers=4):
+        """Create independent arrays concurrently.
+
+           stspecs: one stspec per array, 'phydevs' holding its members.
+           Returns a result per stspec, in the same order:
+               {'members': .., 'array': '/dev/mdN' (None on failure),
+                'error': exception or None, 'elapsed': seconds}
+        """
+        done = [0]
+
+        def _create(stspec):
+            result = {'members': stspec['phydevs'],
+                      'array': None,
+                      'error': None}
+            start = time.time()
+            try:
+                result['array'] = LVM.create_software_raid(root_helper, stspec)
+            except Exception as err:
+                result['error'] = err
+            result['elapsed'] = time.time() - start
+
+            done[0] += 1
+            LOG.info(_LI('[MRA] array %(done)d/%(total)d [%(members)s]: '
+                         '%(array)s in %(elapsed).1fs%(error)s')
+                     % {'done': done[0], 'total': len(stspecs),
+                        'members': result['members'],
+                        'array': result['array'],
+                        'elapsed': result['elapsed'],
+                        'error': (', failed: %s' % result['error']
+                                  if result['error'] else '')})
+            return result
+
+        pool = eventlet.GreenPool(workers)
+        return list(pool.imap(_create, stspecs))
 
     @staticmethod
     def remove_array(root_helper, arraydev, vgname=None):
@@ -724,12 +1046,19 @@ class LVM(executor.Executor):
         vgremove [vgname]
         mdadm --stop [arraydev]
         """
+        try:
+            LVM._remove_array(root_helper, arraydev, vgname=vgname)
+        finally:
+            ioarbinventory.invalidate()
+            LVM.invalidate_metadata()
 
+    @staticmethod
+    def _remove_array(root_helper, arraydev, vgname=None):
         if vgname is not None:
             # remove volume group if exists.
             cmd = ['vgremove', '-f', vgname]
             try:
-                (out, _err) = putils.execute(*cmd,
+                (out, _err) = ioarbhelper.execute(*cmd,
                                              root_helper=root_helper,
                                              run_as_root=True)
             except putils.ProcessExecutionError as err:
@@ -743,7 +1072,7 @@ class LVM(executor.Executor):
             # stop the array if it is an array.
             cmd = ['mdadm', '--stop', arraydev]
             try:
-                (out, _err) = putils.execute(*cmd,
+                (out, _err) = ioarbhelper.execute(*cmd,
                                              root_helper=root_helper,
                                              run_as_root=True)
             except putils.ProcessExecutionError as err:
@@ -757,7 +1086,7 @@ class LVM(executor.Executor):
             # stop the array if it is an array.
             cmd = ['pvremove', arraydev]
             try:
-                (out, _err) = putils.execute(*cmd,
+                (out, _err) = ioarbhelper.execute(*cmd,
                                              root_helper=root_helper,
                                              run_as_root=True)
             except putils.ProcessExecutionError as err:
@@ -774,7 +1103,7 @@ class LVM(executor.Executor):
         # cat array list
         cmd = ['cat', '/proc/mdstat']
         try:
-            (out, _err) = putils.execute(*cmd,
+            (out, _err) = ioarbhelper.execute(*cmd,
                                          root_helper=root_helper,
                                          run_as_root=True)
             #LOG.debug('[MRA] mdstat out: %(out)s' % {'out': out})
@@ -796,13 +1125,20 @@ class LVM(executor.Executor):
         return arraydevs
 
     @staticmethod
-    def get_jbods_devs(root_helper, vgprefix='cinder-volume-'):
+    def get_jbods_devs(root_helper, vgprefix='cinder-volume-',
+                       snapshot=None):
         """Return block devices configured as JBOD"""
 
         devs = []
+        if snapshot is not None:
+            for vg in snapshot.get_vgs():
+                if vgprefix + 'sd' in vg['name']:
+                    devs.append('/dev/' + vg['name'].split('-')[-1])
+            return devs
+
         cmd = LVM.LVM_CMD_PREFIX + ['vgs', '--noheadings',
                                     '-o', 'name']
-        (out, _err) = putils.execute(*cmd,
+        (out, _err) = ioarbhelper.execute(*cmd,
                                     root_helper=root_helper,
                                     run_as_root=True)
 
@@ -817,6 +1153,7 @@ class LVM(executor.Executor):
         return devs
 
 
+    @_invalidates_metadata
     def create_volume(self, name, size_str, lv_type='default', mirror_count=0, cmd_prefix=None):
         """Creates a logical volume on the object's VG.
 
@@ -836,9 +1173,7 @@ class LVM(executor.Executor):
         # [MRA] this part is mainly for running lvcreate command 
         # inside our container.
         if cmd_prefix is not None:
-            tmp = cmd
-            cmd = cmd_prefix
-            cmd.extend(tmp)
+            cmd = cmd_prefix + cmd
 
         if mirror_count > 0:
             cmd.extend(['-m', mirror_count, '--nosync',
@@ -862,6 +1197,7 @@ class LVM(executor.Executor):
             raise
 
     @utils.retry(putils.ProcessExecutionError)
+    @_invalidates_metadata
     def create_lv_snapshot(self, name, source_lv_name, lv_type='default'):
         """Creates a snapshot of a logical volume.
 
@@ -899,6 +1235,7 @@ class LVM(executor.Executor):
             return name
         return '_' + name
 
+    @_invalidates_metadata
     def activate_lv(self, name, is_snapshot=False):
         """Ensure that logical volume/snapshot logical volume is activated.
 
@@ -935,6 +1272,7 @@ class LVM(executor.Executor):
             LOG.error(_LE('StdErr  :%s') % err.stderr)
             raise
 
+    @_invalidates_metadata
     def delete(self, name):
         """Delete logical volume or snapshot.
 
@@ -982,6 +1320,7 @@ class LVM(executor.Executor):
             LOG.debug('Successfully deleted volume: %s after '
                       'udev settle.', name)
 
+    @_invalidates_metadata
     def revert(self, snapshot_name):
         """Revert an LV from snapshot.
 
@@ -992,7 +1331,13 @@ class LVM(executor.Executor):
                       snapshot_name, root_helper=self._root_helper,
                       run_as_root=True)
 
-    def lv_has_snapshot(self, name):
+    def lv_has_snapshot(self, name, snapshot=None):
+        if snapshot is None:
+            snapshot = self.get_metadata()
+        if snapshot is not None:
+            lvs = snapshot.get_lvs(self.vg_name, name)
+            return bool(lvs) and lvs[0]['attr'][:1] in ('o', 'O')
+
         cmd = LVM.LVM_CMD_PREFIX + ['lvdisplay', '--noheading', '-C', '-o',
                                     'Attr', '%s/%s' % (self.vg_name, name)]
         out, _err = self._execute(*cmd,
@@ -1004,6 +1349,7 @@ class LVM(executor.Executor):
                 return True
         return False
 
+    @_invalidates_metadata
     def extend_volume(self, lv_name, new_size):
         """Extend the size of an existing volume."""
 
@@ -1043,6 +1389,7 @@ class LVM(executor.Executor):
     def vg_mirror_size(self, mirror_count):
         return (self.vg_free_space / (mirror_count + 1))
 
+    @_invalidates_metadata
     def rename_volume(self, lv_name, new_name):
         """Change the name of an existing volume."""
 
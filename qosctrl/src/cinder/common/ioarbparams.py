@@ -22,6 +22,8 @@
 
 from oslo_log import log as logging
 
+from cinder.common import ioarbperf
+
 # IOArbiter specific keys.
 STTYPE = 'ioarb_sttype'
 STTYPE_MANUAL = 'ioarb-manual'
@@ -30,6 +32,54 @@ RTYPE_SIZE = 'size'
 RTYPE_IOPS4K = 'iops-4k'
 RTYPE_IOPS4K_R = 'iops-4k-r'
 RTYPE_IOPS4K_W = 'iops-4k-w'
+RTYPE_IOPS4K_BURST = 'iops-4k-burst'    # maxiops above miniops
+RTYPE_BW = 'bw'     # MB/s
+
+# Resource types checked by admission control, besides the capacity.
+QOS_RTYPES = [RTYPE_IOPS4K, RTYPE_IOPS4K_R, RTYPE_IOPS4K_W,
+              RTYPE_IOPS4K_BURST, RTYPE_BW]
+
+# Resource types every ioarbiter host reports. The others are optional,
+# as containers configured by older versions do not report them.
+REQUIRED_RTYPES = [RTYPE_SIZE, RTYPE_IOPS4K]
+
+# Resource types budgeted in 4KB-equivalent IOPS. (see normalize_demand)
+IOPS_RTYPES = [RTYPE_IOPS4K, RTYPE_IOPS4K_R, RTYPE_IOPS4K_W,
+               RTYPE_IOPS4K_BURST]
+
+BUDGET_IOSIZE = ioarbperf.BUDGET_IOSIZE
+
+# stspec field that holds the reserved amount of each resource type.
+# A volume may issue all of its reserved IOPS as reads or as writes,
+# so 'miniops' is reserved on every IOPS budget. The size is only
+# known in reservation entries.
+DEMAND_MAPPING = {
+    RTYPE_SIZE: 'size',
+    RTYPE_IOPS4K: 'miniops',
+    RTYPE_IOPS4K_R: 'miniops',
+    RTYPE_IOPS4K_W: 'miniops',
+    RTYPE_IOPS4K_BURST: 'maxiops',
+    RTYPE_BW: 'minbw' }
+
+# Capability keys that a provisioned cinder-volume reports for each
+# resource type: (total budget, provisioned amount).
+# Burst IOPS are taken from the mixed IOPS budget.
+CAPS_KEY_MAPPING = {
+    RTYPE_IOPS4K: ('total_iops_4k', 'provisioned_iops_4k'),
+    RTYPE_IOPS4K_R: ('total_iops_4k_r', 'provisioned_iops_4k_r'),
+    RTYPE_IOPS4K_W: ('total_iops_4k_w', 'provisioned_iops_4k_w'),
+    RTYPE_IOPS4K_BURST: ('total_iops_4k', 'provisioned_iops_4k_burst'),
+    RTYPE_BW: ('total_bw', 'provisioned_bw') }
+
+# Per-disk performance units. (4KB IOPS, MB/s)
+IOPS_UNIT_MAPPING = {
+    'hdd': 200,
+    'ssd': 70000,
+    'nvme': 700000 }
+BW_UNIT_MAPPING = {
+    'hdd': 150,
+    'ssd': 500,
+    'nvme': 2000 }
 
 # Constants for software RAID configuration. ('storage_class' field)
 RAID_MAPPING = {
@@ -43,10 +93,10 @@ NDISK_MAPPING = {
     'ioarb-silver': 4,
     'ioarb-bronze': 1 }
 MAX_IOPS_MAPPING = {
-    'ioarb-platinum': 30000,
-    'ioarb-gold': 1000,
-    'ioarb-silver': 500,
-    'ioarb-bronze': 100 }
+    'ioarb-platinum': 60000,
+    'ioarb-gold': 2000,
+    'ioarb-silver': 1000,
+    'ioarb-bronze': 200 }
 MIN_IOPS_MAPPING = {
     'ioarb-platinum': 30000,
     'ioarb-gold': 1000,
@@ -57,6 +107,13 @@ IO_SIZE_MAPPING = {
     'ioarb-gold': 4096,
     'ioarb-silver': 4096,
     'ioarb-bronze': 4096 }
+# Seconds a volume with full credits can run at maxiops.
+DEFAULT_BURST_SECONDS = 60
+BURST_SECONDS_MAPPING = {
+    'ioarb-platinum': 60,
+    'ioarb-gold': 60,
+    'ioarb-silver': 60,
+    'ioarb-bronze': 60 }
 MEDIUM_MAPPING = {
     'ioarb-platinum': 'ssd',
     'ioarb-gold': 'any',
@@ -70,11 +127,13 @@ def translate_qosspec(qosspec):
     stspec = {}
     sttype = qosspec[STTYPE]
     if sttype in RAID_MAPPING:
+        # a tier may be given the I/O size of its workload.
         stspec = {
             'raidconf': RAID_MAPPING[sttype],
             'maxiops': MAX_IOPS_MAPPING[sttype],
             'miniops': MIN_IOPS_MAPPING[sttype],
-            'iosize': IO_SIZE_MAPPING[sttype],
+            'iosize': qosspec.get('iosize', IO_SIZE_MAPPING[sttype]),
+            'burstsec': BURST_SECONDS_MAPPING[sttype],
             'medium': MEDIUM_MAPPING[sttype],
             'ndisk': NDISK_MAPPING[sttype] }
     elif sttype == STTYPE_MANUAL:
@@ -85,6 +144,7 @@ def translate_qosspec(qosspec):
             'maxiops': qosspec['maxiops'],
             'miniops': qosspec['miniops'],
             'iosize': qosspec['iosize'],
+            'burstsec': qosspec.get('burstsec', DEFAULT_BURST_SECONDS),
             'medium': qosspec['medium'],
             'ndisk': qosspec['ndisk'] }
     else:
@@ -94,21 +154,117 @@ def translate_qosspec(qosspec):
             'maxiops': 0,
             'miniops': 0,
             'iosize': 4096,
+            'burstsec': 0,
             'medium': 'hdd',
             'ndisk': 1 }
 
+    # Bandwidth reservation: explicit 'minbw' (MB/s) for manual specs,
+    # otherwise what the reserved IOPS amount to at the given I/O size.
+    if sttype == STTYPE_MANUAL and 'minbw' in qosspec:
+        stspec['minbw'] = qosspec['minbw']
+    else:
+        stspec['minbw'] = (float(stspec['miniops']) *
+                           int(stspec['iosize']) / (1024.0 * 1024.0))
+
     return stspec
 
-def get_perf_dict(ndisk, medium, iotype):
-    """Basic IOPS budgetting"""
+def get_demand(stspec, rtype):
+    """Amount of a resource type reserved by a stspec.
+
+       stspec may also be a reservation entry read back from a
+       reservation file, where values are strings and entries written
+       by older versions have no 'minbw'.
 
-    unit = 200
-    if medium == 'hdd':
-        unit = 200
-    elif medium == 'ssd':
-        unit = 70000
-    elif medium == 'nvme':
-        unit = 700000
+       The burst demand is the IOPS a volume may issue above its
+       reservation, i.e. maxiops - miniops.
+    """
+    key = DEMAND_MAPPING[rtype]
+    if rtype == RTYPE_IOPS4K_BURST:
+        if not key in stspec:
+            return 0.0
+        return max(0.0, float(stspec[key]) -
+                        float(stspec.get('miniops', 0)))
+    if key in stspec:
+        return float(stspec[key])
+    if rtype == RTYPE_BW:
+        return (float(stspec.get('miniops', 0)) *
+                get_iosize(stspec) / (1024.0 * 1024.0))
+    return 0.0
+
+def get_iosize(stspec):
+    """I/O size (bytes) of a stspec or a reservation entry."""
+    return int(stspec.get('iosize', BUDGET_IOSIZE))
+
+def get_iosize_cost(iosize, iops, bw):
+    """Cost of one I/O of iosize bytes, in 4KB I/Os.
+
+       iops: 4KB IOPS budget of an array.
+       bw:   bandwidth budget (MB/s) of the same array.
+
+       An I/O costs at least one 4KB I/O. Large I/Os are bound by the
+       bandwidth instead: the array completes bw / iosize of them per
+       second, the time in which it would have completed iops 4KB I/Os.
+    """
+    if iosize <= BUDGET_IOSIZE or not iops or not bw:
+        return 1.0
+    return max(1.0, float(iops) * iosize / (float(bw) * 1024.0 * 1024.0))
+
+def normalize_demand(rtype, amount, iosize, totals):
+    """Convert a demand into the unit an array budgets rtype in.
+
+       IOPS are budgeted as 4KB-equivalent IOPS, so that a volume
+       issuing large I/Os is charged for the device time it takes
+       rather than for its I/O count. totals: {rtype: total budget}
+       of the array. Arrays that do not know their bandwidth budget
+       are charged the plain I/O count.
+    """
+    if rtype not in IOPS_RTYPES:
+        return amount
+    return amount * get_iosize_cost(iosize, totals.get(rtype),
+                                    totals.get(RTYPE_BW))
+
+def get_burst_load(miniops, burstiops, ratio):
+    """Expected peak IOPS of volumes on an array.
+
+       miniops:   IOPS reserved by the volumes.
+       burstiops: IOPS they may burst above that. (RTYPE_IOPS4K_BURST)
+       ratio:     fraction of the burst IOPS expected to be issued at
+                  the same time. Volumes burst on credits they earn
+                  below their reservation (see BurstCredits), so they
+                  rarely burst together; 1.0 means no overcommit.
+    """
+    return float(miniops) + ratio * float(burstiops)
+
+class BurstCredits(object):
+    """Token bucket of a volume.
+
+       A volume is guaranteed miniops. It earns one credit per I/O it
+       does not issue below miniops, spends one per I/O above it, and
+       may run up to maxiops while it has credits. The bucket holds
+       what burstsec seconds at maxiops take.
+    """
+
+    def __init__(self, miniops, maxiops, burstsec):
+        self.miniops = float(miniops)
+        self.maxiops = max(float(maxiops), self.miniops)
+        self.capacity = (self.maxiops - self.miniops) * float(burstsec)
+        self.credits = self.capacity
+
+    def update(self, ios, elapsed):
+        """Account for ios completed in the last elapsed seconds."""
+        self.credits += self.miniops * elapsed - ios
+        self.credits = min(self.capacity, max(0.0, self.credits))
+
+    def get_limit(self):
+        """IOPS limit the volume is allowed to run at now."""
+        if self.credits > 0:
+            return self.maxiops
+        return self.miniops
+
+def _get_raid_dict(ndisk, unit, iotype):
+    """Scale a per-disk performance unit by RAID configuration.
+       iotype: 'r' or 'w'.
+    """
 
     r = {
         'jbod': unit,
@@ -122,19 +278,71 @@ def get_perf_dict(ndisk, medium, iotype):
         'raid1': unit,
         'raid5': (ndisk-1) * unit, 
         'raid6': (ndisk-2) * unit, }
-    rw = {
-        'jbod': min(r['jbod'], w['jbod']),
-        'raid0': min(r['raid0'], w['raid0']),
-        'raid1': min(r['raid1'], w['raid1']),
-        'raid5': min(r['raid5'], w['raid5']),
-        'raid6': min(r['raid6'], w['raid6']), }
 
     if iotype == 'r':
         return r
-    elif iotype == 'w':
-        return w
-    else:
-        return rw
+    return w
+
+def get_device_units(devs, medium):
+    """Per-disk performance units of an array built from devs.
+
+       Profiled figures (see ioarbperf) are used for the devices that
+       have them; others fall back to the units of the given medium.
+       The slowest device bounds the array.
+    """
+    default = {
+        'iops_r': IOPS_UNIT_MAPPING.get(medium, IOPS_UNIT_MAPPING['hdd']),
+        'iops_w': IOPS_UNIT_MAPPING.get(medium, IOPS_UNIT_MAPPING['hdd']),
+        'bw_r': BW_UNIT_MAPPING.get(medium, BW_UNIT_MAPPING['hdd']),
+        'bw_w': BW_UNIT_MAPPING.get(medium, BW_UNIT_MAPPING['hdd']) }
+    if not devs:
+        return default
+
+    units = {}
+    for dev in devs:
+        profiled = {}
+        if not all(k in dev for k in default):
+            # the stats of the device did not carry profiled units.
+            perf_model = ioarbperf.get_perf_model(dev.get('vendor'),
+                                                  dev.get('model'))
+            if perf_model is not None:
+                profiled = perf_model.get_units()
+
+        for k in default:
+            v = dev.get(k)
+            if v is None:
+                v = profiled.get(k)
+            if v is None:
+                v = default[k]
+            units[k] = min(units.get(k, float(v)), float(v))
+
+    return units
+
+def calculate_qos_budget(devs, ndisk, medium):
+    """Calculate IOPS and bandwidth budgets of each RAID configuration.
+       devs: block device information of the array members, or None
+             if only the number of disks and their medium are known.
+    """
+    budget = {}
+    units = get_device_units(devs, medium)
+
+    # IOPS budget calculation. (based on 4KB randrw)
+    # - calculation is based on the following link. 
+    #     - https://en.wikipedia.org/wiki/Standard_RAID_levels
+    # - per-disk units come from profiled data when available.
+    r = _get_raid_dict(ndisk, units['iops_r'], 'r')
+    w = _get_raid_dict(ndisk, units['iops_w'], 'w')
+    budget[RTYPE_IOPS4K_R] = r
+    budget[RTYPE_IOPS4K_W] = w
+    budget[RTYPE_IOPS4K] = dict((k, min(r[k], w[k])) for k in r)
+    budget[RTYPE_IOPS4K_BURST] = budget[RTYPE_IOPS4K]
+
+    # Bandwidth budget calculation. (MB/s, large-block mixed r/w)
+    r = _get_raid_dict(ndisk, units['bw_r'], 'r')
+    w = _get_raid_dict(ndisk, units['bw_w'], 'w')
+    budget[RTYPE_BW] = dict((k, min(r[k], w[k])) for k in r)
+
+    return budget
 
 def calculate_total_budget(devs, stspec):
     """Calculate total budget.
@@ -156,16 +364,6 @@ def calculate_total_budget(devs, stspec):
         'raid6': mindisk * (ndisk - 2) if ndisk > 3 else 0,    # minimum=4
     }
 
-    # IOPS budget calculation. (based on 4KB randrw)
-    # - calculation is based on the following link. 
-    #     - https://en.wikipedia.org/wiki/Standard_RAID_levels
-    # - might be replaced with profiled data.
-    budget[RTYPE_IOPS4K_R] = get_perf_dict(ndisk, stspec['medium'], 'r')
-    budget[RTYPE_IOPS4K_W] = get_perf_dict(ndisk, stspec['medium'], 'w')
-    budget[RTYPE_IOPS4K] = get_perf_dict(ndisk, stspec['medium'], 'rw')
+    budget.update(calculate_qos_budget(devs, ndisk, stspec['medium']))
 
     return budget
-
-
-
-
@@ -0,0 +1,163 @@
+#    Copyright (c) 2015 AT&T Labs Research
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#    Author: Moo-Ryong Ra, mra@research.att.com
+
+"""Profiled per-device performance models
+
+   A profile describes one device model (vendor + model string, as
+   found in /sys/block/<dev>/device/{vendor,model}) and is stored as
+   DEFAULT_PERF_DIR/<vendor>_<model>.json:
+
+       {"vendor": "ATA",
+        "model": "INTEL SSDSC2BB48",
+        "samples": [
+            {"bs": 4096, "readratio": 100, "iodepth": 32,
+             "iops": 75120.3, "bw": 293.4},
+            ...]}
+
+   bs is in bytes, readratio in percent, bw in MB/s. Each sample is
+   one measured point of a single device.
+"""
+
+import json
+import math
+import os
+import re
+
+from oslo_log import log as logging
+
+DEFAULT_PERF_DIR = '/var/lib/cinder/ioarb-perf/'
+
+# Reference I/O patterns a device budget is derived from.
+BUDGET_IOSIZE = 4096
+BUDGET_BW_IOSIZE = 1024 * 1024
+BUDGET_IODEPTH = 32
+
+LOG = logging.getLogger(__name__)
+
+# profile path -> (mtime, DevicePerfModel)
+_models = {}
+
+
+class DevicePerfModel(object):
+    """Measured IOPS/bandwidth of a device model."""
+
+    def __init__(self, vendor, model, samples):
+        self.vendor = vendor
+        self.model = model
+        self.samples = samples
+
+    def _distance(self, sample, bs, readratio, iodepth):
+        # read ratio matters most, then block size, then queue depth.
+        # None if the sample lacks a field or has a non-positive bs or
+        # iodepth, which cannot be compared on a log scale.
+        try:
+            sample_bs = float(sample['bs'])
+            sample_iodepth = float(sample['iodepth'])
+            sample_readratio = float(sample['readratio'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if sample_bs <= 0 or sample_iodepth <= 0:
+            return None
+        return (abs(sample_readratio - readratio),
+                abs(math.log(sample_bs / bs, 2)),
+                abs(math.log(sample_iodepth / iodepth, 2)))
+
+    def lookup(self, bs, readratio, iodepth=BUDGET_IODEPTH):
+        """Return the measured sample closest to an I/O pattern.
+
+           None if there is no usable sample or bs/iodepth is not positive.
+        """
+        if not bs or not iodepth or bs <= 0 or iodepth <= 0:
+            return None
+
+        best = None
+        for sample in self.samples or []:
+            dist = self._distance(sample, float(bs), readratio,
+                                  float(iodepth))
+            if dist is None:
+                continue
+            if best is None or dist < best[0]:
+                best = (dist, sample)
+
+        return best[1] if best is not None else None
+
+    def iops(self, bs, readratio, iodepth=BUDGET_IODEPTH):
+        sample = self.lookup(bs, readratio, iodepth)
+        return float(sample['iops']) if sample is not None else None
+
+    def bw(self, bs, readratio, iodepth=BUDGET_IODEPTH):
+        sample = self.lookup(bs, readratio, iodepth)
+        return float(sample['bw']) if sample is not None else None
+
+    def get_units(self):
+        """Per-device units used for budgeting."""
+        return {
+            'iops_r': self.iops(BUDGET_IOSIZE, 100),
+            'iops_w': self.iops(BUDGET_IOSIZE, 0),
+            'bw_r': self.bw(BUDGET_BW_IOSIZE, 100),
+            'bw_w': self.bw(BUDGET_BW_IOSIZE, 0) }
+
+
+def get_profile_path(vendor, model, perf_dir=DEFAULT_PERF_DIR):
+    name = '%s_%s' % (vendor.strip(), model.strip())
+    return os.path.join(perf_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+                        + '.json')
+
+def get_perf_model(vendor, model, perf_dir=DEFAULT_PERF_DIR):
+    """Load the profile of a device model. None if not profiled."""
+    if vendor is None or model is None:
+        return None
+
+    path = get_profile_path(vendor, model, perf_dir)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    cached = _models.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+        perf_model = DevicePerfModel(profile.get('vendor', vendor),
+                                     profile.get('model', model),
+                                     profile['samples'])
+    except (IOError, ValueError, KeyError) as err:
+        LOG.warning('[MRA] invalid device profile %s: %s' % (path, err))
+        perf_model = None
+
+    _models[path] = (mtime, perf_model)
+    return perf_model
+
+def annotate_blkdev_info(devinfo, perf_dir=DEFAULT_PERF_DIR):
+    """Add profiled units to block device information.
+
+       devinfo: a list from LVM.get_blkdev_info(). Profiled devices get
+       'iops_r', 'iops_w', 'bw_r' and 'bw_w' fields, so that budgets
+       can be calculated where the profiles are not installed.
+    """
+    for dev in devinfo:
+        perf_model = get_perf_model(dev.get('vendor'), dev.get('model'),
+                                    perf_dir)
+        if perf_model is None:
+            continue
+        for k, v in perf_model.get_units().items():
+            if v is not None:
+                dev[k] = v
+
+    return devinfo
@@ -11,20 +11,73 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
-#    
+#
 #    Author: Moo-Ryong Ra, mra@research.att.com
 
-"""Tracking IOArbiter reservation"""
+"""Tracking IOArbiter reservation
+
+   Reservations of an array are kept in a snapshot and a journal.
+   The journal (resv-mdN) is append-only, one JSON record per line:
+
+       {"seq": 12, "time": <epoch>, "op": "add", "key": <volume id>,
+        "data": <stspec>}
+       {"seq": 13, "time": <epoch>, "op": "del", "key": <volume id>}
+
+   The snapshot (resv-mdN.snap) holds the live reservations as of a
+   sequence number:
+
+       {"seq": 11, "entries": {<volume id>: {"time": <epoch>,
+                                             "data": <stspec>}}}
+
+   A ReservationStore keeps an index of the live reservations and the
+   running total of each resource type in memory. Adding or deleting
+   a reservation appends one record, and records appended by other
+   processes (the host driver and the container share the file) are
+   read incrementally. When the journal has grown well past the live
+   reservations, it is compacted: a new snapshot replaces the old one
+   by rename, then an empty journal replaces the old journal. Journal
+   records already covered by the snapshot are skipped by their
+   sequence numbers, so a crash at any point leaves a consistent
+   state, and loading a store costs one snapshot plus a short journal
+   however long the history is.
+
+   Writers hold an inter-process lock (a lock file next to the log) and
+   fsync what they write. Readers need no lock: they never read past
+   the last complete line and notice a compacted file by its inode.
+
+   Files written by older versions (ConfigParser .ini format) are
+   read as they are and converted on the first write.
+"""
 
 import ConfigParser
+import json
+import os
+import time
 
+from oslo_concurrency import lockutils
 from oslo_log import log as logging
 
+from cinder.common import ioarbparams as ioarbiter
+
 DEFAULT_RESV_DIR = '/var/lib/cinder/ioarb-resv/'
 
+# Compact when the journal holds this many records more than there are
+# live reservations.
+COMPACT_SLACK = 64
+
+# Running totals differing from recalculated ones by more than this
+# are reported by reconcile().
+RECONCILE_TOLERANCE = 1e-3
+
+# Resource types a reservation is totaled on.
+RESV_RTYPES = [ioarbiter.RTYPE_SIZE] + ioarbiter.QOS_RTYPES
+
 LOG = logging.getLogger(__name__)
 
-# This function should be in the common library. 
+# path -> ReservationStore
+_stores = {}
+
+# This function should be in the common library.
 # But, in order not to touch openstack distribution,
 # I will keep this function locally.
 def _read_info(fpath):
@@ -33,48 +86,308 @@ def _read_info(fpath):
     config.read(fpath)
     return config
 
-def get_resv_filepath(blkdev):
-    return DEFAULT_RESV_DIR + 'resv-' + blkdev.split('/')[-1]
+def _is_ini_file(fpath):
+    try:
+        with open(fpath) as f:
+            for line in f:
+                if line.strip():
+                    return line.lstrip().startswith('[')
+    except IOError:
+        pass
+    return False
 
-def get_resv_info(path):
-    """Get current reservation information of the deployed volumes."""
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-    config = _read_info(path)
+def get_snapshot_path(path):
+    return path + '.snap'
 
-    data = {}
-    sections = config.sections()
-    for sec in sections:
-        data[sec] = config.items(sec)
+def get_demands(data):
+    """Default demand function: {rtype: amount} of a reservation."""
+    return dict((rtype, ioarbiter.get_demand(data, rtype))
+                for rtype in RESV_RTYPES)
 
-    return data
 
-def add_resv_info(fpath, key, data):
-    """New reservation info."""
+class ReservationStore(object):
+    """Reservations of an array, backed by an append-only log."""
 
-    config = _read_info(fpath)
+    def __init__(self, path, demand_fn=get_demands):
+        self.path = path
+        self.demand_fn = demand_fn
+        self._reset()
 
-    if not config.has_section(key):
-        config.add_section(key)
+    def _reset(self):
+        self.index = {}
+        self.times = {}
+        self.totals = {}
+        self.seq = 0
+        self._demands = {}
+        self._inode = None
+        self._offset = 0
+        self._nrecords = 0
+        self._ini_format = False
 
-    for opt in data:
-        config.set(key, opt, data[opt])
+    def _set(self, key, data, added_at):
+        if key in self._demands:
+            for rtype, amount in self._demands.pop(key).items():
+                self.totals[rtype] -= amount
+            del self.index[key]
+            del self.times[key]
 
-    # save it 
-    with open(fpath, 'wb') as configfile:
-        config.write(configfile)
+        if data is not None:
+            demands = self.demand_fn(data)
+            for rtype, amount in demands.items():
+                self.totals[rtype] = self.totals.get(rtype, 0.0) + amount
+            self._demands[key] = demands
+            self.index[key] = data
+            self.times[key] = added_at
 
+    def _apply(self, record):
+        # records of older versions have no sequence number.
+        seq = record.get('seq', self.seq + 1)
+        if seq <= self.seq:
+            # already in the snapshot.
+            return
+        self.seq = seq
+        self._nrecords += 1
 
-def delete_resv_info(fpath, key):
-    """Delete reservation info."""
+        data = record['data'] if record['op'] == 'add' else None
+        self._set(record['key'], data, record.get('time', 0))
+
+    def _load_snapshot(self):
+        try:
+            with open(get_snapshot_path(self.path)) as f:
+                snapshot = json.load(f)
+        except IOError:
+            return
+        except ValueError:
+            LOG.warning('[MRA] broken reservation snapshot of %s'
+                        % self.path)
+            return
+
+        for key, entry in snapshot['entries'].items():
+            self._set(key, entry['data'], entry.get('time', 0))
+        self.seq = snapshot['seq']
+
+    def _load_ini(self, st):
+        """Load an .ini reservation file. The next write converts it."""
+        config = _read_info(self.path)
+        for sec in config.sections():
+            self._set(sec, dict(config.items(sec)), 0)
+        self._inode = st.st_ino
+        self._offset = st.st_size
+        self._ini_format = True
+
+    def _lock(self):
+        """Inter-process lock of the writers of this file."""
+        return lockutils.lock(os.path.basename(self.path),
+                              lock_file_prefix='ioarb-lock-',
+                              external=True,
+                              lock_path=os.path.dirname(self.path))
+
+    def refresh(self):
+        """Read records appended since the last access.
+
+           A new journal (after a compaction, or at the first access)
+           is read on top of the snapshot.
+        """
+        try:
+            f = open(self.path)
+        except IOError:
+            # removed along with the array.
+            self._reset()
+            return
+
+        with f:
+            # stat what was opened, as it may be renamed over meanwhile.
+            st = os.fstat(f.fileno())
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                # replaced (compacted) by another process.
+                self._reset()
+                if _is_ini_file(self.path):
+                    self._load_ini(st)
+                    return
+                self._load_snapshot()
+                self._inode = st.st_ino
+
+            if st.st_size == self._offset:
+                return
+
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    # being written; read it next time.
+                    break
+                self._offset += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    LOG.warning('[MRA] skipping a broken reservation '
+                                'record in %s' % self.path)
+
+    def _append(self, records):
+        """Append records in one write. Called with the lock held."""
+        if self._ini_format:
+            LOG.debug('[MRA] converting reservation file: %s' % self.path)
+            self._compact()
 
-    config = _read_info(fpath)
+        if records:
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(record, sort_keys=True) + '\n'
+                                for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+            # read them back along with what others have appended.
+            self.refresh()
 
-    if not config.remove_section(key):
-        LOG.debug('[MRA] section does not exist: %s' % key)
+        if self._nrecords > len(self.index) + COMPACT_SLACK:
+            self._compact()
 
-    # save it to the designated location.
-    with open(fpath, 'wb') as configfile:
-        config.write(configfile)
+    def update(self, adds=None, deletes=None):
+        """Apply many reservation changes with a single write.
 
+           adds:    {key: data} of new (or replacing) reservations.
+           deletes: keys of reservations to delete. Unknown keys are
+                    ignored.
+        """
+        with self._lock():
+            self.refresh()
+            now = time.time()
+            records = []
+            for key in (deletes or []):
+                if not key in self.index:
+                    LOG.debug('[MRA] reservation does not exist: %s' % key)
+                    continue
+                records.append({'op': 'del', 'key': key})
+            for key, data in (adds or {}).items():
+                records.append({'op': 'add', 'key': key, 'data': data})
+            for i, record in enumerate(records):
+                record['seq'] = self.seq + i + 1
+                record['time'] = now
+            self._append(records)
 
+    def add(self, key, data):
+        """New reservation info. (replaces an existing one)"""
+        self.update(adds={key: data})
+
+    def delete(self, key):
+        """Delete reservation info."""
+        self.update(deletes=[key])
+
+    def compact(self):
+        """Rewrite the log with live reservations only."""
+        with self._lock():
+            self.refresh()
+            self._compact()
+
+    def _write_file(self, path, content):
+        tmp_path = '%s.tmp-%d' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _compact(self):
+        snapshot = {
+            'seq': self.seq,
+            'entries': dict((key, {'data': data, 'time': self.times[key]})
+                            for key, data in self.index.items()) }
+        self._write_file(get_snapshot_path(self.path),
+                         json.dumps(snapshot, sort_keys=True))
+        self._write_file(self.path, '')
+        _fsync_dir(self.path)
+        self._ini_format = False
+
+        self._inode = os.stat(self.path).st_ino
+        self._offset = 0
+        self._nrecords = 0
+
+    def get(self, key):
+        """data of a reservation. (None if not reserved)"""
+        self.refresh()
+        data = self.index.get(key)
+        return dict(data) if data is not None else None
+
+    def get_time(self, key):
+        """When a reservation was made. (0 if unknown)"""
+        self.refresh()
+        return self.times.get(key, 0)
+
+    def get_info(self):
+        """{key: data} of the live reservations."""
+        self.refresh()
+        return dict((key, dict(data)) for key, data in self.index.items())
+
+    def get_totals(self):
+        """{rtype: total} of the live reservations.
+
+           Only records appended since the last call are read, so this
+           is cheap enough for every stats refresh.
+        """
+        self.refresh()
+        return dict(self.totals)
+
+    def get_total(self, rtype):
+        self.refresh()
+        return self.totals.get(rtype, 0.0)
+
+    def reconcile(self):
+        """Rebuild the store from the whole file and check for drift.
+
+           The running totals are replaced by ones summed from scratch.
+           Returns {rtype: running - recalculated} of the totals that
+           had drifted.
+        """
+        self.refresh()
+        fresh = ReservationStore(self.path, self.demand_fn)
+        fresh.refresh()
+
+        drift = {}
+        for rtype in set(self.totals) | set(fresh.totals):
+            diff = self.totals.get(rtype, 0.0) - fresh.totals.get(rtype, 0.0)
+            if abs(diff) > RECONCILE_TOLERANCE:
+                drift[rtype] = diff
+
+        if drift or set(self.index) != set(fresh.index):
+            LOG.warning('[MRA] reservation drift in %(path)s: '
+                        'totals %(drift)s, %(old)s -> %(new)s entries'
+                        % {'path': self.path, 'drift': drift,
+                           'old': len(self.index), 'new': len(fresh.index)})
+
+        self.__dict__.update(fresh.__dict__)
+        return drift
+
+
+def get_resv_filepath(blkdev):
+    return DEFAULT_RESV_DIR + 'resv-' + blkdev.split('/')[-1]
+
+def get_store(path):
+    """ReservationStore of a reservation file, kept across calls."""
+    store = _stores.get(path)
+    if store is None:
+        store = ReservationStore(path)
+        _stores[path] = store
+    return store
+
+def get_resv_info(path):
+    """Get current reservation information of the deployed volumes."""
+    return get_store(path).get_info()
+
+def add_resv_info(fpath, key, data):
+    """New reservation info."""
+    get_store(fpath).add(key, data)
+
+def delete_resv_info(fpath, key):
+    """Delete reservation info."""
+    get_store(fpath).delete(key)
 
+def update_resv_info(fpath, adds=None, deletes=None):
+    """Apply many reservation changes at once. (see update())"""
+    get_store(fpath).update(adds, deletes)
@@ -0,0 +1,187 @@
+#    Copyright (c) 2015 AT&T Labs Research
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#    Author: Moo-Ryong Ra, mra@research.att.com
+
+"""Runtime IOPS throttling of logical volumes
+
+   Volumes of a container are served by the tgtd process of that
+   container, so a per-device limit on the container's cgroup throttles
+   each LV's device-mapper device separately:
+
+     - cgroup v2: io.max              "MAJ:MIN riops=N wiops=N"
+     - cgroup v1: blkio.throttle.read_iops_device / write_iops_device
+                                      "MAJ:MIN N"
+
+   The kernel limits reads and writes separately, so a volume's limit
+   is split between them by its recent read/write mix (see
+   split_limit()); reads plus writes stay within the limit.
+
+   Limits are written with 'tee' as root, which needs the rootwrap
+   filter below in the container. It allows the limit files only.
+
+       tee: RegExpFilter, tee, root, tee, /sys/fs/cgroup/([^/.][^/]*/)*(io\.max|blkio\.throttle\.(read|write)_iops_device)
+"""
+
+import os
+
+from oslo_concurrency import processutils
+from oslo_log import log as logging
+
+from cinder.i18n import _LE
+from cinder import utils
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Share of a limit either direction gets at least, so that a volume
+# that only wrote recently can still read, and vice versa.
+MIN_SHARE = 0.1
+
+LOG = logging.getLogger(__name__)
+
+
+def _get_own_cgroup(controller):
+    """Path of this process' cgroup. (relative to the hierarchy)"""
+    with open('/proc/self/cgroup') as f:
+        for line in f:
+            _hid, controllers, path = line.strip().split(':', 2)
+            # cgroup v2 lists no controllers. ('0::/path')
+            if controller in controllers.split(','):
+                return path
+    return None
+
+def find_cgroup():
+    """Return (version, cgroup directory) to apply limits in.
+
+       Inside a container, the container's own cgroup is usually the
+       root of the mounted hierarchy. None is returned if no usable
+       hierarchy is found.
+    """
+    if os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+        version, controller = 2, ''
+        root = CGROUP_ROOT
+        limit_file = 'io.max'
+    else:
+        version, controller = 1, 'blkio'
+        root = os.path.join(CGROUP_ROOT, 'blkio')
+        limit_file = 'blkio.throttle.read_iops_device'
+
+    try:
+        path = _get_own_cgroup(controller)
+    except IOError:
+        path = None
+
+    for cgdir in (os.path.join(root, (path or '').lstrip('/')), root):
+        if os.path.exists(os.path.join(cgdir, limit_file)):
+            return version, cgdir
+
+    return None
+
+def get_read_share(reads, writes, default=0.5):
+    """Share of reads in an I/O mix, kept within MIN_SHARE of 0 and 1."""
+    if reads + writes <= 0:
+        return default
+    share = float(reads) / (reads + writes)
+    return min(max(share, MIN_SHARE), 1.0 - MIN_SHARE)
+
+def split_limit(iops, read_share):
+    """Split an IOPS limit into (read IOPS, write IOPS).
+
+       Both are at least 1, as 0 means no limit to blkio (v1).
+    """
+    riops = max(1, int(round(iops * read_share)))
+    wiops = max(1, int(iops) - riops)
+    return riops, wiops
+
+def get_devno(dev_path):
+    """'MAJ:MIN' of a block device."""
+    rdev = os.stat(os.path.realpath(dev_path)).st_rdev
+    return '%d:%d' % (os.major(rdev), os.minor(rdev))
+
+
+class CgroupThrottle(object):
+    """Sets per-device IOPS limits on a cgroup."""
+
+    def __init__(self, version, cgdir, root_helper):
+        self.version = version
+        self.cgdir = cgdir
+        self.root_helper = root_helper
+
+    def _write(self, fname, line):
+        path = os.path.join(self.cgdir, fname)
+        try:
+            utils.execute('tee', path, process_input=line,
+                          root_helper=self.root_helper, run_as_root=True)
+        except processutils.ProcessExecutionError as err:
+            LOG.exception(_LE('Error setting an IOPS limit'))
+            LOG.error(_LE('Cmd     :%s') % err.cmd)
+            LOG.error(_LE('StdOut  :%s') % err.stdout)
+            LOG.error(_LE('StdErr  :%s') % err.stderr)
+            raise
+
+    def set_limit(self, devno, iops, read_share=0.5):
+        """Limit the IOPS of a device. (None: no limit)
+
+           read_share of the limit goes to reads, the rest to writes.
+        """
+        LOG.debug('[MRA] iops limit: %(dev)s -> %(iops)s (read %(rs)s)'
+                  % {'dev': devno, 'iops': iops, 'rs': read_share})
+        if iops is None:
+            riops, wiops = (None, None)
+        else:
+            riops, wiops = split_limit(iops, read_share)
+
+        if self.version == 2:
+            self._write('io.max', '%s riops=%s wiops=%s\n'
+                        % (devno, riops or 'max', wiops or 'max'))
+        else:
+            self._write('blkio.throttle.read_iops_device',
+                        '%s %s\n' % (devno, riops or 0))
+            self._write('blkio.throttle.write_iops_device',
+                        '%s %s\n' % (devno, wiops or 0))
+
+    def clear_limit(self, devno):
+        self.set_limit(devno, None)
+
+    def get_ios(self):
+        """Completed I/Os of each device of the cgroup.
+
+           {devno: (reads, writes)}
+        """
+        ios = {}
+        if self.version == 2:
+            # MAJ:MIN rbytes=.. wbytes=.. rios=.. wios=.. dbytes=.. dios=..
+            with open(os.path.join(self.cgdir, 'io.stat')) as f:
+                for line in f:
+                    fields = line.split()
+                    if not fields:
+                        continue
+                    stat = dict(kv.split('=', 1) for kv in fields[1:]
+                                if '=' in kv)
+                    ios[fields[0]] = (int(stat.get('rios', 0)),
+                                      int(stat.get('wios', 0)))
+        else:
+            # MAJ:MIN Read|Write|Sync|Async|Total N
+            fname = 'blkio.throttle.io_serviced'
+            counts = {}
+            with open(os.path.join(self.cgdir, fname)) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 3 and fields[1] in ('Read', 'Write'):
+                        counts.setdefault(fields[0], {})[fields[1]] = \
+                            int(fields[2])
+            for devno, count in counts.items():
+                ios[devno] = (count.get('Read', 0), count.get('Write', 0))
+
+        return ios
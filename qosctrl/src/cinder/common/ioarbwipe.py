@@ -0,0 +1,115 @@
+#    Copyright (c) 2015 AT&T Labs Research
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#    Author: Moo-Ryong Ra, mra@research.att.com
+
+"""Background wiping of deleted volumes
+
+   Zeroing a volume in delete_volume() blocks the driver for as long as
+   the wipe takes. Instead, the LV of a deleted volume is renamed to a
+   tombstone (ioarb-tomb-<lv name>) and queued; a Wiper zeroes and
+   removes tombstones one at a time in a background greenthread. The
+   space of a tombstone is freed only when it is removed.
+
+   Tombstones survive restarts as LVs; drivers queue them again at
+   startup (see find_tombstones()).
+"""
+
+import collections
+
+import eventlet
+from oslo_log import log as logging
+
+from cinder.i18n import _LE, _LI
+
+TOMBSTONE_PREFIX = 'ioarb-tomb-'
+
+LOG = logging.getLogger(__name__)
+
+
+def get_tombstone_name(lv_name):
+    return TOMBSTONE_PREFIX + lv_name
+
+def is_tombstone(lv_name):
+    return lv_name.startswith(TOMBSTONE_PREFIX)
+
+def get_original_name(tomb_name):
+    return tomb_name[len(TOMBSTONE_PREFIX):]
+
+def find_tombstones(lvs):
+    """Tombstones among LVs. (as from LVM.get_lv_info())"""
+    return [lv for lv in lvs if is_tombstone(lv['name'])]
+
+
+class Wiper(object):
+    """Zeroes and removes tombstones in the background.
+
+       clear_fn(entry):  zero a tombstone.
+       remove_fn(entry): remove its LV.
+       entry: {'name': tombstone, 'size': GB, 'on_done': callable or None}
+       on_done is called once the tombstone is gone. A tombstone that
+       fails is left in place and logged; it is queued again at the
+       next startup.
+    """
+
+    def __init__(self, clear_fn, remove_fn):
+        self.clear_fn = clear_fn
+        self.remove_fn = remove_fn
+        self._queue = collections.deque()
+        self._running = False
+
+    def enqueue(self, name, size, on_done=None):
+        if name in self.get_pending():
+            return
+        self._queue.append({'name': name,
+                            'size': float(size),
+                            'on_done': on_done})
+        LOG.debug('[MRA] tombstone queued: %(name)s (%(num)d pending)'
+                  % {'name': name, 'num': len(self._queue)})
+        if not self._running:
+            self._running = True
+            eventlet.spawn_n(self._run)
+
+    def get_pending(self):
+        return [entry['name'] for entry in self._queue]
+
+    def get_pending_size(self):
+        """GB held by tombstones not removed yet."""
+        return sum(entry['size'] for entry in self._queue)
+
+    def _wipe(self, entry):
+        try:
+            self.clear_fn(entry)
+            self.remove_fn(entry)
+        except Exception:
+            LOG.exception(_LE('Error wiping tombstone %s') % entry['name'])
+            return
+
+        LOG.info(_LI('[MRA] tombstone wiped: %s') % entry['name'])
+        if entry['on_done'] is not None:
+            try:
+                entry['on_done']()
+            except Exception:
+                LOG.exception(_LE('Error after wiping tombstone %s')
+                              % entry['name'])
+
+    def _run(self):
+        try:
+            while self._queue:
+                # stays queued (and counted as pending) while it is wiped.
+                entry = self._queue[0]
+                self._wipe(entry)
+                self._queue.popleft()
+        finally:
+            self._running = False
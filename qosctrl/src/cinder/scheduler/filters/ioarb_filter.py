@@ -15,6 +15,10 @@
 #
 #    Author: Moo-Ryong Ra, mra@research.att.com
 
+import collections
+import time
+
+from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
 import six
@@ -29,216 +33,331 @@ from cinder.volume import qos_specs as qos
 
 LOG = logging.getLogger(__name__)
 
+ioarb_filter_opts = [
+    cfg.IntOpt('ioarb_qos_specs_cache_ttl',
+               default=0,
+               help='Seconds a qos spec fetched by IOArbiterFilter, and the '
+                    'total budget of a host in host mode, are reused across '
+                    'scheduling requests. With 0, a qos spec is fetched '
+                    'once per scheduling request only.'),
+    cfg.FloatOpt('ioarb_burst_overcommit_ratio',
+                 default=0.5,
+                 help='Fraction of the burst IOPS (maxiops above miniops) '
+                      'of the volumes on an array expected to be issued at '
+                      'the same time. Reserved IOPS plus this fraction of '
+                      'the burst IOPS must fit in the IOPS budget. 1.0 '
+                      'disables overcommit of burst IOPS.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ioarb_filter_opts)
+
+# Key under which a qos spec is memoized in filter_properties, which
+# is shared by every host_passes() call of a single scheduling request.
+_REQUEST_QOS_SPECS_KEY = 'ioarb_qos_specs'
+
+# Key under which the compiled AdmissionPlan of a request is memoized.
+_REQUEST_PLAN_KEY = 'ioarb_admission_plan'
+
+# qos_specs_id -> (expiration time, specs). Used when the TTL is set.
+_qos_specs_cache = {}
+
+# (host, medium) -> (capabilities update time, expiration time, total
+# budget) of hosts in 'host' mode. The total budget only changes when
+# the host reports new devices, so it is reused until the host reports
+# again, for at most the qos spec TTL. Expired entries (e.g. of removed
+# hosts) are dropped.
+_total_budget_cache = {}
+
+# The request side of an admission decision. It does not depend on
+# the host, so it is compiled once per scheduling request and every
+# host is then evaluated against it.
+#   backend_name:  requested volume_backend_name (None if not given)
+#   ioarb_request: True if the volume type asks for ioarbiter
+#   stspec:        translated qos spec (None if no ioarbiter qos spec)
+#   raidconf:      requested RAID configuration
+#   ndisk:         requested number of disks
+#   size:          requested volume size in GB
+#   demand:        tuple of (resource type, requested amount). IOPS
+#                  are in I/Os of the requested size, see
+#                  get_host_demand() for what they cost on a host.
+AdmissionPlan = collections.namedtuple('AdmissionPlan', [
+    'backend_name', 'ioarb_request', 'stspec', 'raidconf', 'ndisk',
+    'size', 'demand'])
+
+
+def _get_qos_specs(qos_specs_id, filter_properties):
+    """Fetch qos specs once per request (and per TTL if configured)."""
+    cached = filter_properties.get(_REQUEST_QOS_SPECS_KEY)
+    if cached is not None and cached[0] == qos_specs_id:
+        return cached[1]
+
+    ttl = CONF.ioarb_qos_specs_cache_ttl
+    now = time.time()
+    entry = _qos_specs_cache.get(qos_specs_id)
+    if ttl > 0 and entry is not None and entry[0] > now:
+        qos_specs = entry[1]
+    else:
+        ctxt = context.get_admin_context()
+        qos_specs = qos.get_qos_specs(ctxt, qos_specs_id)['specs']
+        if ttl > 0:
+            _qos_specs_cache[qos_specs_id] = (now + ttl, qos_specs)
+
+    filter_properties[_REQUEST_QOS_SPECS_KEY] = (qos_specs_id, qos_specs)
+    return qos_specs
+
+
+def _get_request_demand(stspec, rtype):
+    """Requested amount of a resource type."""
+    if rtype == ioarbiter.RTYPE_IOPS4K_BURST:
+        # burst IOPS are checked together with the reserved ones.
+        return ioarbiter.get_burst_load(
+            ioarbiter.get_demand(stspec, ioarbiter.RTYPE_IOPS4K),
+            ioarbiter.get_demand(stspec, rtype),
+            CONF.ioarb_burst_overcommit_ratio)
+    return ioarbiter.get_demand(stspec, rtype)
+
+
+def compile_admission_plan(filter_properties):
+    """Translate a scheduling request into an AdmissionPlan (once)."""
+    plan = filter_properties.get(_REQUEST_PLAN_KEY)
+    if plan is not None:
+        return plan
+
+    volume_type = filter_properties.get('volume_type') or {}
+    extra_specs = volume_type.get('extra_specs') or {}
+    request_spec = filter_properties.get('request_spec') or {}
+    volume_stats = request_spec.get('volume_properties') or {}
+    size = float(volume_stats.get('size') or 0)
+
+    stspec = None
+    raidconf = None
+    ndisk = 0
+    demand = ()
+
+    qos_specs_id = volume_type.get('qos_specs_id')
+    if qos_specs_id is not None:
+        qos_specs = _get_qos_specs(qos_specs_id, filter_properties)
+        # a qos spec not meant for ioarbiter (e.g. a front-end one) has
+        # nothing to translate; _check_host_type() decides such hosts.
+        if ioarbiter.STTYPE in qos_specs:
+            stspec = ioarbiter.translate_qosspec(qos_specs)
+            raidconf = stspec['raidconf']
+            ndisk = int(stspec['ndisk'])
+            demand = ((ioarbiter.RTYPE_SIZE, size),) + tuple(
+                (rtype, _get_request_demand(stspec, rtype))
+                for rtype in ioarbiter.QOS_RTYPES)
+
+    plan = AdmissionPlan(
+        backend_name=extra_specs.get('volume_backend_name'),
+        ioarb_request=ioarbiter.STTYPE in extra_specs,
+        stspec=stspec,
+        raidconf=raidconf,
+        ndisk=ndisk,
+        size=size,
+        demand=demand)
+
+    LOG.debug('[MRA] admission plan: %(plan)s' % {'plan': plan})
+    filter_properties[_REQUEST_PLAN_KEY] = plan
+    return plan
+
+
+def _get_total_budget(host_state, devs, stspec):
+    """calculate_total_budget() of a host, until it reports again."""
+    ttl = CONF.ioarb_qos_specs_cache_ttl
+    if ttl <= 0:
+        _total_budget_cache.clear()
+        return ioarbiter.calculate_total_budget(devs, stspec)
+
+    key = (host_state.host, stspec['medium'])
+    updated = getattr(host_state, 'updated', None)
+    now = time.time()
+    entry = _total_budget_cache.get(key)
+    if (entry is not None and updated is not None and
+            entry[0] == updated and entry[1] > now):
+        return entry[2]
+
+    for k, v in _total_budget_cache.items():
+        if v[1] <= now:
+            del _total_budget_cache[k]
+
+    tot_budget = ioarbiter.calculate_total_budget(devs, stspec)
+    _total_budget_cache[key] = (updated, now + ttl, tot_budget)
+    return tot_budget
+
+
+def get_host_budget(plan, host_state):
+    """Return {rtype: (total, deployed)} of a host for the plan's demand.
+
+       Resource types the host does not report are left out. Missing
+       optional ones are not enforced on it, while a host missing one of
+       ioarbiter.REQUIRED_RTYPES fails the filter.
+
+       None is returned if the host cannot serve the request regardless
+       of its remaining budget, e.g. RAID parameters do not match.
+    """
+    host_caps = host_state.capabilities
+    cvtype = host_caps['ioarb_cvtype']
+    budget = {}
+
+    if cvtype == 'host':
+        # Calculate host's total capacity. In 'host' mode,
+        # no volumes are deployed.
+        devs = host_caps['ioarb_resource']
+        if len(devs) < plan.ndisk:
+            LOG.debug('[MRA] %s vs. %s' % (len(devs), plan.ndisk))
+            return None
+
+        # Get a total budget for a) storage capacity, b) iops budget.
+        # Make sure if the deployed cinder volumes are using
+        # the same translator function.
+        tot_budget = _get_total_budget(host_state, devs, plan.stspec)
+        for rtype, _reqnum in plan.demand:
+            budget[rtype] = (float(tot_budget[rtype][plan.raidconf]), 0.0)
+    elif cvtype == 'provisioned':
+        # Check capacity.
+        # This function may be redundant if CapacityFilter is already
+        # used. (It is enabled by default in Kilo.)
+        if plan.size > host_state.free_capacity_gb:
+            return None
+
+        # Chek RAID conf.
+        if (host_caps['ioarb_raidconf'] != plan.raidconf or
+                host_caps['ioarb_ndisk'] != str(plan.ndisk)):
+            LOG.debug('[MRA] redundancy params do not match.')
+            LOG.debug('[MRA] raid %s vs. %s' %
+                      (host_caps['ioarb_raidconf'], plan.raidconf))
+            LOG.debug('[MRA] ndisk %s vs. %s' %
+                      (host_caps['ioarb_ndisk'], plan.ndisk))
+            return None
+
+        # In 'provisioned' mode, the container already knows its total
+        # budget and cinder-volume process reports the deployed one.
+        # Containers configured by older versions may not report every
+        # resource type.
+        budget[ioarbiter.RTYPE_SIZE] = (
+            float(host_state.total_capacity_gb),
+            float(host_caps['provisioned_capacity_gb']))
+        for rtype in ioarbiter.QOS_RTYPES:
+            total_key, prov_key = ioarbiter.CAPS_KEY_MAPPING[rtype]
+            if (host_caps.get(total_key) is not None and
+                    host_caps.get(prov_key) is not None):
+                budget[rtype] = (float(host_caps[total_key]),
+                                 float(host_caps[prov_key]))
+
+        # The IOPS budget has to hold the reserved IOPS plus the
+        # expected share of burst IOPS as well.
+        burst = ioarbiter.RTYPE_IOPS4K_BURST
+        if burst in budget and ioarbiter.RTYPE_IOPS4K in budget:
+            tot, burst_used = budget[burst]
+            budget[burst] = (tot, ioarbiter.get_burst_load(
+                budget[ioarbiter.RTYPE_IOPS4K][1], burst_used,
+                CONF.ioarb_burst_overcommit_ratio))
+        else:
+            budget.pop(burst, None)
+    else:
+        LOG.error('[MRA] unknown cinder-volume type: %s' % cvtype)
+        return None
+
+    return budget
+
+
+def get_host_demand(plan, budget):
+    """Return the plan's demand in the units of a host's budget.
+
+       The cost of an I/O larger than 4KB depends on the IOPS/bandwidth
+       balance of the host's array, so IOPS demands are converted per
+       host. (see ioarbparams.normalize_demand)
+    """
+    iosize = ioarbiter.get_iosize(plan.stspec)
+    totals = dict((rtype, tot) for rtype, (tot, _used) in budget.items())
+
+    return tuple((rtype, ioarbiter.normalize_demand(rtype, reqnum,
+                                                    iosize, totals))
+                 for rtype, reqnum in plan.demand)
+
+
 class IOArbiterFilter(filters.BaseHostFilter):
     """IOArbiterFilter filters hosts based on provided block devices information.
 
     IOArbFilter filters based on volume host's provided 'filter function'
-    and metrics.
+    and metrics. The request side is compiled once per scheduling request
+    (see AdmissionPlan), so each host costs a few comparisons.
     """
 
     def host_passes(self, host_state, filter_properties):
         """Determines whether a host passes ioarbiter filter."""
-        stats = self._generate_stats(host_state, filter_properties)
+        plan = compile_admission_plan(filter_properties)
 
-        result = self._check_filter_function(stats)
-        LOG.debug("[MRA] filtering result: %s -> %s" % 
-                 (stats['host_stats']['host'], result))
+        result = self._check_filter_function(plan, host_state)
+        LOG.debug("[MRA] filtering result: %s -> %s" %
+                 (host_state.host, result))
 
         return result
 
-    def _check_filter_function(self, stats):
-        """Checks if a volume passes a host's filter function.
+    def _check_filter_function(self, plan, host_state):
+        """Checks if a volume passes a host's filter function."""
+        result = self._check_host_type(plan, host_state)
+        if result is not None:
+            return result
+
+        budget = get_host_budget(plan, host_state)
+        if budget is None:
+            return False
+
+        # See if there is a remaining capacity both in terms of
+        # capacity & qos budget.
+        for rtype, reqnum in get_host_demand(plan, budget):
+            if not self._check_budget(budget, rtype, reqnum):
+                return False
 
-           Returns a tuple in the format (filter_passing, filter_invalid).
-           Both values are booleans.
+        return True
+
+    def _check_host_type(self, plan, host_state):
+        """Checks whether a host is of the kind the request asks for.
+
+           Returns True/False when that alone decides the result, or None
+           when the host's budget has to be checked.
         """
-        filter_result = False
-
-        host_stats = stats['host_stats']
-        host_caps = stats['host_caps']
-        extra_specs = stats['extra_specs']
-        qos_specs = stats['qos_specs']
-        volume_stats = stats['volume_stats']
-        volume_type = stats['volume_type']
-
-        LOG.debug('[MRA] =================')
-        LOG.debug('[MRA] host_stats: %(dt)s' % {'dt': host_stats})
-        LOG.debug('[MRA] host_caps: %(dt)s' % {'dt': host_caps})
-        LOG.debug('[MRA] extra_specs: %(dt)s' % {'dt': extra_specs})
-        LOG.debug('[MRA] volume_stats: %(dt)s' % {'dt': volume_stats})
-        LOG.debug('[MRA] volume_type: %(dt)s' % {'dt': volume_type})
-        LOG.debug('[MRA] qos_specs: %(dt)s' % {'dt': qos_specs})
-        LOG.debug('[MRA] =================')
 
         # Check that the volume types match, i.e., ioarb_sttype = "ioarbiter"
-        if (extra_specs is None or 'volume_backend_name' not in extra_specs):
+        if plan.backend_name is None:
             LOG.warning(_LW("No 'volume_backend_name' key in extra_specs. "
                             "Skipping volume backend name check."))
-        elif (extra_specs['volume_backend_name'] !=
-                host_stats['volume_backend_name']):
+        elif plan.backend_name != host_state.volume_backend_name:
             LOG.warning(_LW("Volume backend names do not match: '%(target)s' "
                             "vs '%(current)s' :: Skipping"),
-                        {'target': extra_specs['volume_backend_name'],
-                         'current': host_stats['volume_backend_name']})
+                        {'target': plan.backend_name,
+                         'current': host_state.volume_backend_name})
             return False
 
         # Check either host or request does not know ioarbiter.
-        if not 'ioarb_cvtype' in host_caps:
-            if 'ioarb_sttype' in extra_specs:
-                return False
-            else:
-                return True
-        else:
-            if qos_specs is None:
-                # This might be a policy decision. 
-                # currently, ioarbiter cinder-volume does not
-                # handle volume creation request without qos_specs.
-                return False
-
-        # Check cinder-volume type: 'host' or 'provisioned'
-        cvtype = host_caps['ioarb_cvtype']
-        stspec = ioarbiter.translate_qosspec(qos_specs)
-
-        tot_budget = {}
-        deployed = {}
-
-        if cvtype == 'host':
-            # Calculate host's total capacity.
-            devs = host_caps['ioarb_resource']
-            LOG.debug('[MRA] host mode: available devs - %(devs)s' % 
-                          {'devs': host_caps['ioarb_resource']})
-
-            if len(host_caps['ioarb_resource']) < int(stspec['ndisk']):
-                LOG.debug('[MRA] %s vs. %s' % 
-                    (len(host_caps['ioarb_resource']), int(stspec['ndisk'])))
-                return False
-    
-            # Get a total budget for a) storage capacity, b) iops budget.
-            # Make sure if the deployed cinder volumes are using 
-            # the same translator function.
-            tot_budget = ioarbiter.calculate_total_budget(devs, stspec)
-        elif cvtype == 'provisioned':
-            # in terms of container, it already know its total cap.
-            LOG.debug('[MRA] provisioned mode')
-          
-            # Check capacity.
-            # This function may be redundant if CapacityFilter is already 
-            # used. (It is enabled by default in Kilo.)
-            if volume_stats['size'] > host_stats['free_capacity_gb']: 
-                return False
-
-            # Chek RAID conf.
-            if (host_caps['ioarb_raidconf'] <> stspec['raidconf'] or
-                host_caps['ioarb_ndisk'] <> str(stspec['ndisk'])):
-                LOG.debug('[MRA] redundancy params do not match.')
-                LOG.debug('[MRA] raid %s vs. %s' % 
-                              (host_caps['ioarb_raidconf'], stspec['raidconf']))
-                LOG.debug('[MRA] ndisk %s vs. %s' % 
-                              (host_caps['ioarb_ndisk'], stspec['ndisk']))
-                return False
-
-            # Check qos budget.
-            tot_budget[ioarbiter.RTYPE_SIZE] = {
-                host_caps['ioarb_raidconf']: host_stats['total_capacity_gb']}
-            tot_budget[ioarbiter.RTYPE_IOPS4K] = {
-                host_caps['ioarb_raidconf']: host_caps['total_iops_4k']}
+        if not 'ioarb_cvtype' in host_state.capabilities:
+            return not plan.ioarb_request
+        elif plan.stspec is None:
+            # This might be a policy decision.
+            # currently, ioarbiter cinder-volume does not
+            # handle volume creation request without qos_specs.
+            return False
 
-        # Get already deployed qos-aware volumes' information.
-        deployed = self._calculate_deployed_capacity(cvtype, host_caps, stspec)
+        return None
 
-        # See if there is a remaining capacity both in terms of 
-        # capacity & qos budget.
-        filter_result = (
-            self._check_budget(tot_budget, deployed, stspec, 
-                               ioarbiter.RTYPE_SIZE, volume_stats['size']) and
-            self._check_budget(tot_budget, deployed, stspec, 
-                               ioarbiter.RTYPE_IOPS4K, stspec['miniops'])
-            )
-
-        return filter_result
-
-    def _check_budget(self, budget, deployed, stspec, rtype, reqnum):
-        """We are doing a capacity (and other) check (perhaps) again 
-           since CapacityFilter cannot know what could be exact available 
+    def _check_budget(self, budget, rtype, reqnum):
+        """We are doing a capacity (and other) check (perhaps) again
+           since CapacityFilter cannot know what could be exact available
            storage space after QoS requirements are applied.
         """
-        if (not 'raidconf' in stspec or
-            not rtype in budget or
-            not rtype in deployed):
-            LOG.warning('[MRA] a field is missing')
-            return False
+        if not rtype in budget:
+            if rtype in ioarbiter.REQUIRED_RTYPES:
+                LOG.warning(_LW('[MRA] %s is not reported by the host.'),
+                            rtype)
+                return False
+            LOG.debug('[MRA] %s is not reported by the host. '
+                      'skipping.' % rtype)
+            return True
 
-        tot = float(budget[rtype][stspec['raidconf']])
-        used = float(deployed[rtype][stspec['raidconf']])
+        tot, used = budget[rtype]
 
         LOG.debug('[MRA] budget chk: %s, %s, %s' % (rtype, reqnum, tot-used))
-        LOG.debug('[MRA] decision: %s' % (float(reqnum) < tot - used))
-        
-        return (float(reqnum) < tot - used)
-
-    def _calculate_deployed_capacity(self, cvtype, hostinfo, stspec):
-        """Calculate already consumed resources.
-           Currently only supports size and IOPS.
-        """
-        deployed = {}
-
-        if cvtype == 'host':
-            # In 'host' mode, no volumes are deployed.
-            deployed[ioarbiter.RTYPE_SIZE] = {
-                'jbod': 0, 'raid0': 0, 'raid1': 0, 'raid5': 0, 'raid6': 0}
-            deployed[ioarbiter.RTYPE_IOPS4K] = {
-                'jbod': 0, 'raid0': 0, 'raid1': 0, 'raid5': 0, 'raid6': 0}
-        elif cvtype == 'provisioned':
-            # In 'provisioned' mode, cinder-volume process will report info.
-            deployed[ioarbiter.RTYPE_SIZE] = { 
-                stspec['raidconf']: hostinfo['provisioned_capacity_gb'] }
-            deployed[ioarbiter.RTYPE_IOPS4K] = { 
-                stspec['raidconf']: hostinfo['provisioned_iops_4k'] }
-        else:
-            LOG.error('[MRA] unknown cinder-volume type: %s' % cvtype)
-            raise
-
-        return deployed
-
-    def _generate_stats(self, host_state, filter_properties):
-        """Generates statistics from host and volume data."""
-
-        host_stats = {
-            'host': host_state.host,
-            'volume_backend_name': host_state.volume_backend_name,
-            'vendor_name': host_state.vendor_name,
-            'driver_version': host_state.driver_version,
-            'storage_protocol': host_state.storage_protocol,
-            'QoS_support': host_state.QoS_support,
-            'total_capacity_gb': host_state.total_capacity_gb,
-            'allocated_capacity_gb': host_state.allocated_capacity_gb,
-            'free_capacity_gb': host_state.free_capacity_gb,
-            'reserved_percentage': host_state.reserved_percentage,
-            'updated': host_state.updated,
-        }
-
-        host_caps = host_state.capabilities
-        volume_type = filter_properties.get('volume_type', {})
-        extra_specs = volume_type.get('extra_specs', {})
-        request_spec = filter_properties.get('request_spec', {})
-        volume_stats = request_spec.get('volume_properties', {})
-
-        ctxt = context.get_admin_context()
-        qos_specs_id = volume_type.get('qos_specs_id')
-        if qos_specs_id is not None:
-            qos_specs = qos.get_qos_specs(ctxt, qos_specs_id)['specs']
-        else:
-            qos_specs = None
-
-        stats = {
-            'host_stats': host_stats,
-            'host_caps': host_caps,
-            'extra_specs': extra_specs,
-            'qos_specs': qos_specs,
-            'volume_stats': volume_stats,
-            'volume_type': volume_type,
-        }
-
-        return stats
-
 
+        return (reqnum < tot - used)
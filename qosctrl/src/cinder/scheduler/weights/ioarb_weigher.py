@@ -0,0 +1,83 @@
+# Copyright (c) 2015 AT&T Labs Research
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#    Author: Moo-Ryong Ra, mra@research.att.com
+
+"""
+IOArbiter Weigher. Weigh hosts by their remaining QoS budget.
+
+The remaining budget is computed the same way IOArbiterFilter does it
+(total minus deployed, for every resource type the request asks for),
+after the requested amount has been taken out. A host is scored by
+the fraction left on its scarcest resource type.
+
+The default is to spread volumes across hosts with the most headroom.
+Set ioarb_weight_multiplier to a negative number to pack volumes onto
+the fullest hosts instead.
+"""
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from cinder.openstack.common.scheduler import weights
+from cinder.scheduler.filters import ioarb_filter
+
+LOG = logging.getLogger(__name__)
+
+ioarb_weight_opts = [
+    cfg.FloatOpt('ioarb_weight_multiplier',
+                 default=1.0,
+                 help='Multiplier used for weighing remaining QoS budget. '
+                      'Negative numbers mean to pack vs spread.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ioarb_weight_opts)
+
+
+class IOArbiterWeigher(weights.BaseHostWeigher):
+    def weight_multiplier(self):
+        """Override the weight multiplier."""
+        return CONF.ioarb_weight_multiplier
+
+    def _weigh_object(self, host_state, weight_properties):
+        """Higher weights win. We want spreading to be the default."""
+        if not 'ioarb_cvtype' in host_state.capabilities:
+            return 0.0
+
+        plan = ioarb_filter.compile_admission_plan(weight_properties)
+        if plan.stspec is None:
+            return 0.0
+
+        budget = ioarb_filter.get_host_budget(plan, host_state)
+        if budget is None:
+            return 0.0
+
+        headroom = None
+        for rtype, reqnum in ioarb_filter.get_host_demand(plan, budget):
+            if not rtype in budget:
+                continue
+            tot, used = budget[rtype]
+            if tot <= 0:
+                left = 0.0
+            else:
+                left = (tot - used - reqnum) / tot
+            headroom = left if headroom is None else min(headroom, left)
+
+        if headroom is None:
+            return 0.0
+
+        LOG.debug('[MRA] headroom: %s -> %s' % (host_state.host, headroom))
+        return headroom
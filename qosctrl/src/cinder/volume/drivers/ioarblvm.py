@@ -26,21 +26,28 @@ import os
 import socket
 import time
 
+import eventlet
+import json
 from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import importutils
 from oslo_utils import units
+import six
 
 from cinder import context
 from cinder.brick import exception as brick_exception
 from cinder.brick.local_dev import ioarblvm as lvm
 from cinder.brick.local_dev import ioarbcontainer as contutil
+from cinder.brick.local_dev import ioarbhelper
+from cinder.brick.local_dev import ioarbinventory
 from cinder import exception
 from cinder.i18n import _, _LE, _LI, _LW
 from cinder.image import image_utils
 from cinder.openstack.common import fileutils
+from cinder.openstack.common import loopingcall
 from cinder.common import ioarbparams as ioarbiter
+from cinder.common import ioarbperf as ioarbperf
 from cinder.common import ioarbresv as ioarbresv
 from cinder import utils
 
@@ -76,13 +83,50 @@ volume_opts = [
     cfg.IntOpt('reclaim_interval',
                default=300,
                help='How much you would wait before you reclaim block resources.'),
+    cfg.IntOpt('ioarb_reclaim_check_interval',
+               default=60,
+               help='How often, in seconds, arrays are checked for '
+                    'reclaim. (see reclaim_interval)'),
+    cfg.IntOpt('ioarb_stats_interval',
+               default=10,
+               help='How often, in seconds, volume stats are collected in '
+                    'the background. get_volume_stats() returns the latest '
+                    'ones with their age.'),
+    cfg.StrOpt('ioarb_raidstat_file',
+               default='/var/lib/cinder/ioarb-container/raidstat.json',
+               help='Where the idle state of arrays is kept, so that '
+                    'their idle time survives restarts.'),
     cfg.StrOpt('physical_devices',
                default='auto',
                help='This setting contains a list of block devices that'
                     'ioarbiter backend will manage.                    '
                     'Example:                                          '
                     'physical_devices = /dev/sdl,/dev/sdm,/dev/sdn     '
-                    'physical_devices = auto                           ')
+                    'physical_devices = auto                           '),
+    cfg.IntOpt('ioarb_bulk_workers',
+               default=4,
+               help='How many arrays create_volumes_bulk() builds at the '
+                    'same time.'),
+    cfg.StrOpt('ioarb_helper_socket',
+               default=None,
+               help='Unix socket of the IOArbiter privileged helper. If '
+                    'set, commands run as root go to the helper instead '
+                    'of forking the root helper. '
+                    'Example: /var/run/cinder/ioarb-helper.sock'),
+    cfg.IntOpt('ioarb_lvm_cache_ttl',
+               default=5,
+               help='Seconds LVM metadata (VGs, LVs, PVs) read by LVM '
+                    'queries is reused. Changes made by this driver drop '
+                    'it at once. 0 disables the cache.'),
+    cfg.IntOpt('ioarb_inventory_max_age',
+               default=300,
+               help='Seconds cached block device information is kept '
+                    'when no device change is detected.'),
+    cfg.DictOpt('ioarb_warm_pool',
+                default={},
+                help='Number of pre-built arrays to keep per tier, with '
+                     'their container backends running. '
+                     'Example: ioarb-gold:1,ioarb-silver:2'),
 ]
 
 CONF = cfg.CONF
@@ -99,6 +143,14 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
         super(IOArbLVMVolumeDriver, self).__init__(*args, **kwargs)
 
         self.configuration.append_config_values(volume_opts)
+
+        # [MRA] run privileged commands through the helper daemon.
+        helper_socket = self.configuration.ioarb_helper_socket
+        if helper_socket:
+            ioarbhelper.configure(helper_socket)
+            self.set_execute(ioarbhelper.execute)
+            LOG.debug('[MRA] privileged helper: %s' % helper_socket)
+
         self.hostname = socket.gethostname()
         self.vg = vg_obj
         self.backend_name =\
@@ -123,16 +175,30 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
         self.protocol = self.target_driver.protocol
 
         # [MRA] ioarbiter specifics.
+        ioarbinventory.get_inventory().max_age = \
+            self.configuration.ioarb_inventory_max_age
+        lvm.LVM.METADATA_TTL = self.configuration.ioarb_lvm_cache_ttl
         self.ref_physical_devices = self.configuration.physical_devices
         self._update_available_physical_devices()
 
-        self.raidstat = {}
+        # {array: [lv count, since when, VG uuid]}
+        self.raidstat = self._load_raidstat()
+        self._reclaim_timer = None
+        self._stats_timer = None
+        self._stats_time = None
+
+        # pre-built arrays, handed out to volumes of their layout.
+        self._warm_pool = []
+        self._replenishing = False
 
     def _update_available_physical_devices(self):
         """Filter out already-in-use devices"""
         root_helper = utils.get_root_helper()
         old_devlist = self.ref_physical_devices.split(',')
-        new_devlist = lvm.LVM.filter_blkdev_in_use(root_helper, old_devlist)
+        # served from the device inventory until devices change.
+        new_devlist = ioarbinventory.get_inventory().lookup(
+            ('in-use', tuple(old_devlist)),
+            lambda: lvm.LVM.filter_blkdev_in_use(root_helper, old_devlist))
         LOG.debug('[MRA] orig: %(old)s, filtered: %(new)s' 
                      % {'old': old_devlist, 'new': new_devlist})
         # put back with original format.
@@ -214,11 +280,10 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
 
         # [MRA] piggypack periodic tasks here.
         root_helper = utils.get_root_helper()
-        self._reclaim_unused_storage()
+        self._replenish_warm_pool()
         ndev = self._update_available_physical_devices()
         if ndev == 0:
             LOG.debug("[MRA] nothing to update. ndev=0")
-            self._stats = {}
             #return
 
         LOG.debug(("Updating volume stats"))
@@ -261,12 +326,19 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
 #            provisioned_capacity = round(
 #                float(total_capacity) - float(free_capacity), 2)
 
-        if ndev == 0:
+        # disks of warm arrays are as good as free: a tier without a
+        # warm array gets them by releasing one. (see create_volume)
+        phydevs = [dev for dev in
+                   self.configuration.physical_devices.split(',') if dev]
+        phydevs.extend(self._get_warm_pool_devices())
+
+        if len(phydevs) == 0:
             devinfo = []
             total_capacity = 0
         else:
-            devinfo = lvm.LVM.get_blkdev_info(
-                root_helper, self.configuration.physical_devices)
+            devinfo = lvm.LVM.get_blkdev_info(root_helper, ','.join(phydevs))
+            # let the scheduler budget with profiled device performance.
+            devinfo = ioarbperf.annotate_blkdev_info(devinfo)
             total_capacity = sum(dev['size'] for dev in devinfo)
 
         free_capacity = total_capacity
@@ -384,34 +456,154 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
                     raise exception.VolumeBackendAPIException(
                         data=exception_message)
 
+    def do_setup(self, context):
+        """Start collecting stats and reclaiming idle arrays on timers
+           of their own.
+        """
+        self._recreate_outdated_containers(utils.get_root_helper())
+
+        self._stats_timer = loopingcall.FixedIntervalLoopingCall(
+            self._collect_stats)
+        # the first collection is the manager's refresh.
+        self._stats_timer.start(
+            interval=self.configuration.ioarb_stats_interval,
+            initial_delay=self.configuration.ioarb_stats_interval)
+
+        self._reclaim_timer = loopingcall.FixedIntervalLoopingCall(
+            self._reclaim_periodic)
+        self._reclaim_timer.start(
+            interval=self.configuration.ioarb_reclaim_check_interval,
+            initial_delay=self.configuration.ioarb_reclaim_check_interval)
+
+    def _recreate_outdated_containers(self, root_helper):
+        """Recreate containers of existing arrays with outdated mounts.
+
+           (see contutil.check_container_is_running) The container's
+           cinder.conf and the array's reservations are kept.
+        """
+        snapshot = lvm.LVMSnapshot.load(root_helper)
+        arraydevs = lvm.LVM.get_raid_arrays(root_helper)
+        arraydevs.extend(lvm.LVM.get_jbods_devs(
+            root_helper, contutil._get_cont_vg_prefix(), snapshot=snapshot))
+
+        for arrdev in arraydevs:
+            config = {'container_name': contutil._get_container_name(arrdev),
+                      'config_path': contutil._get_conf_path(arrdev),
+                      'container_image': contutil._get_container_image(),
+                      'resv_info': ioarbresv.get_resv_filepath(arrdev)}
+            if not os.path.exists(config['config_path']):
+                # not an array of ours.
+                continue
+            try:
+                config = contutil.check_container_is_running(config,
+                                                             root_helper)
+                if not config.get('outdated'):
+                    continue
+                config = contutil.create_container_instance(config,
+                                                            root_helper)
+                config = contutil.configure_container_instance(config,
+                                                               root_helper)
+                contutil.restart_processes_in_container(
+                    config['container_name'], ['tgt', 'cinder-volume'],
+                    root_helper)
+            except processutils.ProcessExecutionError:
+                # logged already. the others are still checked.
+                LOG.warning(_LW('[MRA] container of %s is not checked.')
+                            % arrdev)
+
+    def _collect_stats(self):
+        try:
+            self._update_volume_stats()
+        except Exception:
+            # keep the timer running; the last stats are served meanwhile.
+            LOG.exception(_LE('Error collecting volume stats.'))
+            return
+        self._stats_time = time.time()
+
+    def _reclaim_periodic(self):
+        try:
+            self._reclaim_unused_storage()
+        except Exception:
+            # keep the timer running.
+            LOG.exception(_LE('Error reclaiming unused storage.'))
+
+    def _load_raidstat(self):
+        path = self.configuration.ioarb_raidstat_file
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            LOG.warning(_LW('[MRA] ignoring a broken array state file: %s')
+                        % path)
+            return {}
+
+    def _save_raidstat(self):
+        path = self.configuration.ioarb_raidstat_file
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.raidstat, f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            LOG.exception(_LE('Error saving array state to %s') % path)
+
     def _reclaim_unused_storage(self):
-        """If an empty array exists, reclaim it for future use.""" 
+        """If an empty array exists, reclaim it for future use.
+
+           Arrays and their LV counts come from one mdstat read and one
+           LVM scan. An array is reclaimed once it has had no LV for
+           reclaim_interval seconds. The state is saved across restarts,
+           and an array is told apart from an earlier one of the same
+           name by its VG uuid.
+        """ 
 
         # get root_helper.
         root_helper = utils.get_root_helper()
         arraydevs = lvm.LVM.get_raid_arrays(root_helper)
+        # one LVM scan for all arrays.
+        snapshot = lvm.LVMSnapshot.load(root_helper)
         jboddevs = lvm.LVM.get_jbods_devs(root_helper, 
-                                          contutil._get_cont_vg_prefix())
+                                          contutil._get_cont_vg_prefix(),
+                                          snapshot=snapshot)
         arraydevs.extend(jboddevs)
 
+        # warm arrays are empty on purpose.
+        pooled = set(entry['blkdev'] for entry in self._warm_pool)
+
+        raidstat = {}
         for arrdev in arraydevs:
+            if arrdev in pooled:
+                continue
             vgname = contutil._get_cont_vg_name(arrdev)
-            cnt = lvm.LVM.get_lvcnt_by_vgname(root_helper, vgname)
-            if cnt == 0:
-                if (arrdev in self.raidstat and self.raidstat[arrdev][0] == 0):
-                    if (time.time() - self.raidstat[arrdev][1] > 
-                            self.configuration.reclaim_interval):
-                        # reclaim it if it has been unused for more than 5 min.
-                        contutil.remove_cont_cinder_volume(root_helper, arrdev)
-                        lvm.LVM.remove_array(root_helper, 
-                                             arrdev, 
-                                             vgname=vgname)
-                        del self.raidstat[arrdev]
-                        LOG.debug('[MRA] array [%(arr)s] has been reclaimed' % {'arr': arrdev})
+            vgs = snapshot.get_vgs(vgname)
+            if not vgs:
+                # not ours, or its VG is not created yet.
+                continue
+            uuid = vgs[0]['uuid']
+            cnt = vgs[0]['lv_count']
+
+            stat = self.raidstat.get(arrdev)
+            if stat is not None and stat[2:] == [uuid] and stat[0] == cnt:
+                if (cnt == 0 and time.time() - stat[1] >
+                        self.configuration.reclaim_interval):
+                    # reclaim it if it has been unused for more than 5 min.
+                    contutil.remove_cont_cinder_volume(root_helper, arrdev)
+                    lvm.LVM.remove_array(root_helper, 
+                                         arrdev, 
+                                         vgname=vgname)
+                    LOG.debug('[MRA] array [%(arr)s] has been reclaimed' % {'arr': arrdev})
                     continue
+                raidstat[arrdev] = stat
+                continue
 
             # update stat.
-            self.raidstat[arrdev] = [cnt, time.time()]
+            raidstat[arrdev] = [cnt, time.time(), uuid]
+
+        if raidstat != self.raidstat:
+            self.raidstat = raidstat
+            self._save_raidstat()
 
 
     # [MRA] this function is copied from solidfire driver.
@@ -427,8 +619,13 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
         return voltype, qosspec
 
 
-    def _fork_cinder_volume_service(self, blkdev, root_helper, stspec, volume):
-        """Create (or retrieve) a container for cinder-volume service."""
+    def _fork_cinder_volume_service(self, blkdev, root_helper, stspec, volumes,
+                                    devinfo=None):
+        """Create (or retrieve) a container for cinder-volume service.
+
+           volumes: volumes to be created on the array. All of them are
+           reserved at once, and the container is set up only once.
+        """
 
         LOG.debug('[MRA] entered _fork_cinder_volume_service()'
                   ' with [%(blk)s]' % {'blk': blkdev})
@@ -439,15 +636,19 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
 
         # create a cinder.conf for the container.
         config = contutil.create_cinder_conf_for_container(blkdev, 
-                                                           stspec, None)
+                                                           stspec, None,
+                                                           devinfo=devinfo)
 
         # memo reservation info.
         resv_fpath = ioarbresv.get_resv_filepath(blkdev)
-        ioarbresv.add_resv_info(resv_fpath, volume['id'], stspec)
+        ioarbresv.update_resv_info(
+            resv_fpath,
+            adds=dict((volume['id'], dict(stspec, size=volume['size']))
+                      for volume in volumes))
 
         # create a container instance.
-        config = contutil.check_container_is_running(config, root_helper)
         config['resv_info'] = resv_fpath
+        config = contutil.check_container_is_running(config, root_helper)
         if not 'container_id' in config:
             config = contutil.create_container_instance(config, root_helper)
 
@@ -461,27 +662,8 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
 
         return config
 
-    def create_volume(self, volume):
-        """Creates a logical volume.
-           [MRA] this function is extended to support dynamic
-           RAID configuration. 
-        """
-
-        # ensure usable block devices.
-        ndev = self._update_available_physical_devices()
-        if ndev == 0:
-            LOG.error('[MRA] no available block devices.')
-            raise
-
-        # variable initialization.
-        root_helper = utils.get_root_helper()
-        vtype = None
-        qosspec = None
-
-        mirror_count = 0
-        if self.configuration.lvm_mirrors:
-            mirror_count = self.configuration.lvm_mirrors
-
+    def _get_stspec(self, volume):
+        """Translate the qos spec of a volume's type into a stspec."""
         ctxt = context.get_admin_context()
         type_id = volume['volume_type_id']
         if type_id is not None:
@@ -498,16 +680,47 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
 
         # qosspec translation.
         stspec = ioarbiter.translate_qosspec(qosspec)
-        stspec['phydevs'] = self.configuration.physical_devices
         LOG.debug('[MRA] setup: %(spec)s' % {'spec': stspec})
 
-        # sanity check.
-        if len(stspec['phydevs']) == 0:
-            LOG.error('[MRA] no avaialble physical devices.')
-            raise
+        return stspec
+
+    @utils.synchronized('ioarb-phydevs')
+    def _create_array(self, root_helper, stspec, exact=False):
+        """Create an array of the first ndisk available devices.
+
+           Devices are picked and assembled under a lock, so that
+           concurrent creations (and the warm pool) never pick the
+           same ones. Returns (stspec with the members as 'phydevs',
+           array device), or (None, None) if no device is available,
+           or with exact, if fewer than ndisk are.
+        """
+        ndisk = int(stspec['ndisk'])
+        self._update_available_physical_devices()
+        phydevs = [dev for dev in
+                   self.configuration.physical_devices.split(',') if dev]
+
+        # array members, the same ones create_software_raid() picks.
+        members = phydevs[0:ndisk]
+        if len(members) == 0 or (exact and len(members) < ndisk):
+            return None, None
+
+        stspec = dict(stspec, phydevs=','.join(members))
 
         # software RAID configuration. new_raiddev looks like '/dev/md[n]'
-        new_blkdev = lvm.LVM.create_software_raid(root_helper, stspec)
+        return stspec, lvm.LVM.create_software_raid(root_helper, stspec)
+
+    def _setup_array(self, root_helper, stspec, new_blkdev, volumes):
+        """Create the given volumes on a new array.
+
+           stspec: 'phydevs' holds the members of the array.
+           The VG and the container of the array are set up once, then
+           the LVs of all volumes are created in the container.
+        """
+        mirror_count = 0
+        if self.configuration.lvm_mirrors:
+            mirror_count = self.configuration.lvm_mirrors
+
+        devinfo = lvm.LVM.get_blkdev_info(root_helper, stspec['phydevs'])
         new_vgname = contutil._get_cont_vg_name(new_blkdev)
 
         # logical volume creation.
@@ -517,14 +730,52 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
 
         # invoke a container & update volume metadata.
         config = self._fork_cinder_volume_service(
-                     new_blkdev, root_helper, stspec, volume)
+                     new_blkdev, root_helper, stspec, volumes, devinfo=devinfo)
         cmd_prefix = contutil.get_cmdprefix_for_exec_in_cont(config)
-        self._create_volume(volume['name'],
-                            self._sizestr(volume['size']),
-                            self.configuration.lvm_type,
-                            mirror_count,
-                            vg=newvg,
-                            cmd_prefix=cmd_prefix)
+        for volume in volumes:
+            self._create_volume(volume['name'],
+                                self._sizestr(volume['size']),
+                                self.configuration.lvm_type,
+                                mirror_count,
+                                vg=newvg,
+                                cmd_prefix=cmd_prefix)
+
+        return config
+
+    def create_volume(self, volume):
+        """Creates a logical volume.
+           [MRA] this function is extended to support dynamic
+           RAID configuration. 
+        """
+
+        # variable initialization.
+        root_helper = utils.get_root_helper()
+        stspec = self._get_stspec(volume)
+
+        entry = self._take_warm_array(stspec)
+        if entry is not None:
+            config = self._use_warm_array(root_helper, entry, stspec,
+                                          [volume])
+        else:
+            # warm disks are advertised to every tier; free them for a
+            # tier that has no warm array if they are needed.
+            arrspec, new_blkdev = self._create_array(root_helper, stspec,
+                                                     exact=True)
+            while (new_blkdev is None and
+                    self._release_warm_array(root_helper)):
+                arrspec, new_blkdev = self._create_array(root_helper,
+                                                         stspec, exact=True)
+            if new_blkdev is None:
+                arrspec, new_blkdev = self._create_array(root_helper,
+                                                         stspec)
+            if new_blkdev is None:
+                LOG.error('[MRA] no available block devices.')
+                raise
+            config = self._setup_array(root_helper, arrspec, new_blkdev,
+                                       [volume])
+
+        # make up for what was taken, or for the disks just used.
+        self._replenish_warm_pool()
 
         # return new cinder-volume endpoint.
         newhost = (config['container_name'] + '@' + config['backend_name'])
@@ -534,6 +785,316 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
 
         return { 'host': newhost }
 
+    def _get_layout(self, stspec):
+        """What an array is built for: volumes of the same layout can
+           share one.
+        """
+        return (stspec['raidconf'], int(stspec['ndisk']), stspec['medium'])
+
+    def _is_warm_array_empty(self, entry):
+        """Whether a warm array is still unused.
+
+           The container of a warm array advertises itself like any
+           other, so the scheduler may have placed volumes on it.
+        """
+        store = ioarbresv.get_store(entry['config']['resv_info'])
+        return not store.get_info() and not entry['vg'].get_volumes()
+
+    def _prune_warm_pool(self):
+        """Drop warm arrays that got volumes; they are arrays in use now."""
+        for entry in list(self._warm_pool):
+            if not self._is_warm_array_empty(entry):
+                self._warm_pool.remove(entry)
+                LOG.info(_LI('[MRA] warm array [%s] is in use; dropped '
+                             'from the pool.') % entry['blkdev'])
+
+    def _release_warm_array(self, root_helper):
+        """Tear down a warm array, so that its disks can be used.
+
+           Returns False if the pool is empty.
+        """
+        self._prune_warm_pool()
+        if not self._warm_pool:
+            return False
+
+        entry = self._warm_pool.pop()
+        LOG.info(_LI('[MRA] releasing warm array [%(arr)s] of %(tier)s.')
+                 % {'arr': entry['blkdev'], 'tier': entry['sttype']})
+        contutil.remove_cont_cinder_volume(root_helper, entry['blkdev'])
+        lvm.LVM.remove_array(root_helper, entry['blkdev'],
+                             vgname=entry['vg'].vg_name)
+        return True
+
+    def _get_warm_pool_devices(self):
+        """Member devices of the warm arrays."""
+        self._prune_warm_pool()
+        devs = []
+        for entry in self._warm_pool:
+            devs.extend(entry['members'])
+        return devs
+
+    def _take_warm_array(self, stspec):
+        """Hand out a warm array for the layout of stspec, if any."""
+        layout = self._get_layout(stspec)
+        self._prune_warm_pool()
+        for entry in self._warm_pool:
+            if entry['layout'] == layout:
+                self._warm_pool.remove(entry)
+                LOG.debug('[MRA] warm array [%(arr)s] is taken for %(lay)s'
+                          % {'arr': entry['blkdev'], 'lay': layout})
+                return entry
+        return None
+
+    def _use_warm_array(self, root_helper, entry, stspec, volumes):
+        """Create the given volumes on a warm array.
+
+           Its VG and container are already up, so the volumes are
+           reserved and their LVs created; no service is restarted.
+        """
+        mirror_count = 0
+        if self.configuration.lvm_mirrors:
+            mirror_count = self.configuration.lvm_mirrors
+
+        config = entry['config']
+        ioarbresv.update_resv_info(
+            config['resv_info'],
+            adds=dict((volume['id'], dict(stspec, size=volume['size']))
+                      for volume in volumes))
+
+        cmd_prefix = contutil.get_cmdprefix_for_exec_in_cont(config)
+        for volume in volumes:
+            self._create_volume(volume['name'],
+                                self._sizestr(volume['size']),
+                                self.configuration.lvm_type,
+                                mirror_count,
+                                vg=entry['vg'],
+                                cmd_prefix=cmd_prefix)
+
+        return config
+
+    def _build_warm_array(self, root_helper, sttype):
+        """Build an empty array of a tier with its container running.
+
+           Returns a warm pool entry, or None if the tier's ndisk
+           devices are not available.
+        """
+        stspec = ioarbiter.translate_qosspec({ioarbiter.STTYPE: sttype})
+        stspec, new_blkdev = self._create_array(root_helper, stspec,
+                                                exact=True)
+        if new_blkdev is None:
+            return None
+
+        devinfo = lvm.LVM.get_blkdev_info(root_helper, stspec['phydevs'])
+        newvg = lvm.LVM(contutil._get_cont_vg_name(new_blkdev), root_helper,
+                        create_vg=True,
+                        physical_volumes=[ new_blkdev ])
+        config = self._fork_cinder_volume_service(
+                     new_blkdev, root_helper, stspec, [], devinfo=devinfo)
+
+        return {'sttype': sttype,
+                'layout': self._get_layout(stspec),
+                'members': stspec['phydevs'].split(','),
+                'blkdev': new_blkdev,
+                'vg': newvg,
+                'config': config}
+
+    def _replenish_warm_pool(self):
+        """Refill the warm pool in the background. (one refill at a time)"""
+        if not self.configuration.ioarb_warm_pool or self._replenishing:
+            return
+        self._replenishing = True
+        eventlet.spawn_n(self._fill_warm_pool)
+
+    def _fill_warm_pool(self):
+        root_helper = utils.get_root_helper()
+        try:
+            self._prune_warm_pool()
+            for sttype, count in sorted(
+                    self.configuration.ioarb_warm_pool.items()):
+                if not sttype in ioarbiter.RAID_MAPPING:
+                    LOG.warning(_LW('[MRA] unknown tier in ioarb_warm_pool: '
+                                    '%s') % sttype)
+                    continue
+
+                while (len([entry for entry in self._warm_pool
+                            if entry['sttype'] == sttype]) < int(count)):
+                    entry = self._build_warm_array(root_helper, sttype)
+                    if entry is None:
+                        LOG.debug('[MRA] not enough devices for a warm '
+                                  '%s array.' % sttype)
+                        break
+                    self._warm_pool.append(entry)
+                    LOG.info(_LI('[MRA] warm array [%(arr)s] of %(tier)s '
+                                 'is ready.')
+                             % {'arr': entry['blkdev'], 'tier': sttype})
+        except Exception:
+            LOG.exception(_LE('Error building warm arrays.'))
+        finally:
+            self._replenishing = False
+
+    def _plan_arrays(self, root_helper, stspec, volumes):
+        """Pack volumes into new arrays, as few as their budgets allow.
+
+           Disks are taken in order, ndisk per array, as for a single
+           volume. An array takes volumes while their sizes and reserved
+           QoS (IOPS, bandwidth) fit in its budget. Burst IOPS are left
+           to the scheduler's overcommit.
+
+           Returns ([(members, volumes)], volumes that did not fit).
+        """
+        ndisk = int(stspec['ndisk'])
+        raidconf = stspec['raidconf']
+        iosize = ioarbiter.get_iosize(stspec)
+        phydevs = [dev for dev in stspec['phydevs'].split(',') if dev]
+        devinfo = lvm.LVM.get_blkdev_info(root_helper, ','.join(phydevs))
+        devinfo = dict((dev['dev'], dev)
+                       for dev in ioarbperf.annotate_blkdev_info(devinfo))
+
+        plan = []
+        pending = list(volumes)
+        while pending and len(phydevs) >= ndisk:
+            members = phydevs[0:ndisk]
+            phydevs = phydevs[ndisk:]
+            devs = [devinfo[dev.replace('/dev/', '')] for dev in members]
+            budget = ioarbiter.calculate_total_budget(devs, stspec)
+            totals = dict((rtype, float(budget[rtype][raidconf]))
+                          for rtype in budget)
+
+            demand = {}
+            for rtype in ioarbiter.QOS_RTYPES:
+                if rtype == ioarbiter.RTYPE_IOPS4K_BURST:
+                    continue
+                demand[rtype] = ioarbiter.normalize_demand(
+                    rtype, ioarbiter.get_demand(stspec, rtype), iosize,
+                    totals)
+
+            used = dict((rtype, 0.0) for rtype in totals)
+            placed = []
+            left = []
+            for volume in pending:
+                demand[ioarbiter.RTYPE_SIZE] = float(volume['size'])
+                if all(demand[rtype] < totals[rtype] - used[rtype]
+                       for rtype in demand):
+                    for rtype in demand:
+                        used[rtype] += demand[rtype]
+                    placed.append(volume)
+                else:
+                    left.append(volume)
+
+            if not placed:
+                # does not fit even in an empty array.
+                break
+            plan.append((members, placed))
+            pending = left
+
+        LOG.debug('[MRA] bulk plan: %(plan)s, unplaced: %(left)s'
+                  % {'plan': [(m, len(v)) for m, v in plan],
+                     'left': len(pending)})
+        return plan, pending
+
+    @utils.synchronized('ioarb-phydevs')
+    def _create_arrays(self, root_helper, stspec, volumes, workers):
+        """Plan and assemble the arrays of many volumes.
+
+           Like _create_array(), under the device lock.
+           Returns (plan, unplaced volumes, stspec of each array,
+           create_software_raids() result of each array).
+        """
+        # ensure usable block devices.
+        ndev = self._update_available_physical_devices()
+        if ndev == 0:
+            msg = (_('No available block devices for %d volumes.')
+                   % len(volumes))
+            LOG.error('[MRA] %s' % msg)
+            raise exception.VolumeBackendAPIException(data=msg)
+
+        stspec = dict(stspec, phydevs=self.configuration.physical_devices)
+        plan, unplaced = self._plan_arrays(root_helper, stspec, volumes)
+
+        # assemble the arrays.
+        arrspecs = [dict(stspec, phydevs=','.join(members))
+                    for members, _vols in plan]
+        results = lvm.LVM.create_software_raids(root_helper, arrspecs,
+                                                workers=workers)
+        return plan, unplaced, arrspecs, results
+
+    def _discard_array(self, root_helper, arrdev, volumes):
+        """Undo a failed array setup: reservations, container, array."""
+        ioarbresv.update_resv_info(ioarbresv.get_resv_filepath(arrdev),
+                                   deletes=[volume['id']
+                                            for volume in volumes])
+        vgname = contutil._get_cont_vg_name(arrdev)
+        try:
+            contutil.remove_cont_cinder_volume(root_helper, arrdev)
+            if not lvm.LVMSnapshot.load(root_helper).get_vgs(vgname):
+                vgname = None
+            lvm.LVM.remove_array(root_helper, arrdev, vgname=vgname)
+        except processutils.ProcessExecutionError:
+            # logged already. an empty array is reclaimed later.
+            LOG.warning(_LW('[MRA] array [%s] is not removed.') % arrdev)
+
+    def create_volumes_bulk(self, volumes):
+        """Creates many volumes of the same volume type at once.
+
+           Placement is planned once, the arrays are assembled in
+           parallel, then they are set up in parallel, each with a
+           single container setup and restart.
+           Returns ({volume id: model update}, {volume id: error}).
+
+           The Kilo volume manager has no bulk path, so this is a driver
+           entry point only: a caller (e.g. a provisioning script that
+           loads the driver) passes volumes already in the database in
+           'creating' state, and sets their host from the model updates
+           as the manager does for create_volume().
+        """
+        if not volumes:
+            return {}, {}
+
+        if len(set(volume['volume_type_id'] for volume in volumes)) > 1:
+            raise exception.InvalidInput(
+                reason=_('Volumes created in bulk must have the same '
+                         'volume type.'))
+
+        root_helper = utils.get_root_helper()
+        stspec = self._get_stspec(volumes[0])
+        workers = self.configuration.ioarb_bulk_workers
+        plan, unplaced, arrspecs, results = self._create_arrays(
+            root_helper, stspec, volumes, workers)
+
+        updates = {}
+        errors = {}
+        for volume in unplaced:
+            errors[volume['id']] = 'not enough block devices'
+
+        def _setup(arrspec, result, vols):
+            if result['error'] is not None:
+                return vols, None, result['error']
+            try:
+                config = self._setup_array(root_helper, arrspec,
+                                           result['array'], vols)
+            except Exception as err:
+                LOG.exception(_LE('Error setting up array %s')
+                              % result['array'])
+                self._discard_array(root_helper, result['array'], vols)
+                return vols, None, err
+            return vols, config, None
+
+        # set up VGs, containers and volumes.
+        pool = eventlet.GreenPool(workers)
+        for vols, config, err in pool.starmap(
+                _setup, zip(arrspecs, results, [v for _m, v in plan])):
+            for volume in vols:
+                if err is not None:
+                    errors[volume['id']] = six.text_type(err)
+                else:
+                    updates[volume['id']] = {
+                        'host': (config['container_name'] + '@' +
+                                 config['backend_name']) }
+
+        LOG.debug('[MRA] bulk creation: %(ok)s created, %(err)s failed'
+                  % {'ok': len(updates), 'err': len(errors)})
+        return updates, errors
+
 
     def create_volume_from_snapshot(self, volume, snapshot):
         """Creates a volume from a snapshot."""
@@ -675,13 +1236,28 @@ class IOArbLVMVolumeDriver(driver.VolumeDriver):
     def get_volume_stats(self, refresh=False):
         """Get volume status.
 
-        If 'refresh' is True, run update the stats first.
+        [MRA] stats are collected in the background (see do_setup()), so
+        the latest ones are returned at once, with their age in seconds
+        as 'ioarb_stats_age'. 'refresh' only matters before the first
+        collection, which then runs here.
         """
 
-        if refresh:
-            self._update_volume_stats()
-
-        return self._stats
+        if self._stats_time is None:
+            if refresh:
+                self._collect_stats()
+            if self._stats_time is None:
+                # not collected yet, or the collection failed.
+                return self._stats
+
+        age = round(time.time() - self._stats_time, 1)
+        if age > 3 * self.configuration.ioarb_stats_interval:
+            LOG.warning(_LW('[MRA] volume stats are %ss old.') % age)
+
+        stats = dict(self._stats, ioarb_stats_age=age)
+        if 'pools' in stats:
+            stats['pools'] = [dict(pool, ioarb_stats_age=age)
+                              for pool in stats['pools']]
+        return stats
 
     def extend_volume(self, volume, new_size):
         """Extend an existing volume's size."""
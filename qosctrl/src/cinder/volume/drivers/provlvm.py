@@ -22,6 +22,7 @@ Driver for Linux servers running LVM.
 import math
 import os
 import socket
+import time
 
 from oslo_concurrency import processutils
 from oslo_config import cfg
@@ -44,6 +45,8 @@ from cinder.volume import qos_specs
 from cinder.volume import volume_types
 from cinder.common import ioarbparams as ioarbiter
 from cinder.common import ioarbresv as ioarbresv
+from cinder.common import ioarbthrottle
+from cinder.common import ioarbwipe
 
 LOG = logging.getLogger(__name__)
 
@@ -80,6 +83,38 @@ volume_opts = [
     cfg.StrOpt('ioarb_total_iops_4k',
                default='200',
                help='Total IOPS that can be used for IOPS reservation.'),
+    cfg.StrOpt('ioarb_total_iops_4k_r',
+               default=None,
+               help='Total read IOPS that can be used for IOPS reservation.'),
+    cfg.StrOpt('ioarb_total_iops_4k_w',
+               default=None,
+               help='Total write IOPS that can be used for IOPS reservation.'),
+    cfg.StrOpt('ioarb_total_bw',
+               default=None,
+               help='Total bandwidth (MB/s) that can be used for '
+                    'bandwidth reservation.'),
+    cfg.IntOpt('ioarb_resv_reconcile_interval',
+               default=600,
+               help='Seconds between recalculations of the provisioned '
+                    'totals from the whole reservation file. Totals are '
+                    'otherwise updated incrementally.'),
+    cfg.IntOpt('ioarb_resv_replay_grace',
+               default=300,
+               help='Reservations without a logical volume are dropped '
+                    'at startup once they are older than this many '
+                    'seconds. Younger ones may belong to volumes being '
+                    'created.'),
+    cfg.BoolOpt('ioarb_iops_throttle',
+                default=True,
+                help='Enforce maxiops of each volume with a cgroup '
+                     'blkio/io.max IOPS limit on its device. Volumes run '
+                     'at maxiops while they have burst credits and at '
+                     'miniops otherwise.'),
+    cfg.IntOpt('ioarb_wipe_iops',
+               default=200,
+               help='IOPS limit on a deleted volume while it is zeroed '
+                    'in the background (with ioarb_iops_throttle). '
+                    'volume_clear_ionice applies as well. 0: no limit.'),
 ]
 
 CONF = cfg.CONF
@@ -98,6 +133,15 @@ class LVMVolumeDriver(driver.VolumeDriver):
         self.configuration.append_config_values(volume_opts)
         self.hostname = socket.gethostname()
         self.vg = vg_obj
+        # [MRA] runtime IOPS limits. volume id -> limit state.
+        self.throttle = None
+        self._iops_limits = {}
+        # [MRA] reservation store of the array. (see _get_resv_store)
+        self._resv_store = None
+        self._resv_reconciled = 0
+        # [MRA] zeroes deleted volumes in the background.
+        self.wiper = ioarbwipe.Wiper(self._clear_tombstone,
+                                     self._remove_tombstone)
         self.backend_name =\
             self.configuration.safe_get('volume_backend_name') or 'LVM'
 
@@ -125,54 +169,95 @@ class LVMVolumeDriver(driver.VolumeDriver):
     def _volume_not_present(self, volume_name):
         return self.vg.get_volume(volume_name) is None
 
-    def _delete_volume(self, volume, is_snapshot=False):
-        """Deletes a logical volume."""
-        if self.configuration.volume_clear != 'none' and \
-                self.configuration.lvm_type != 'thin':
-            self._clear_volume(volume, is_snapshot)
+    def _delete_volume(self, volume, is_snapshot=False, on_done=None):
+        """Deletes a logical volume.
 
+           [MRA] a volume to be cleared is renamed to a tombstone and
+           zeroed and removed in the background. on_done is called once
+           the LV is gone.
+
+           Snapshots are removed at once, without zeroing their CoW
+           area: a snapshot tombstone would keep its origin busy (see
+           delete_volume) until the wipe is done.
+        """
         name = volume['name']
         if is_snapshot:
             name = self._escape_snapshot(volume['name'])
+
+        if self.configuration.volume_clear != 'none' and \
+                self.configuration.lvm_type != 'thin' and not is_snapshot:
+            size_in_g = volume.get('volume_size') or volume.get('size')
+            if size_in_g is None:
+                msg = (_LE("Size for volume: %s not found, "
+                       "cannot secure delete.") % volume['id'])
+                LOG.error(msg)
+                raise exception.InvalidParameterValue(msg)
+
+            tomb_name = ioarbwipe.get_tombstone_name(name)
+            self.vg.rename_volume(name, tomb_name)
+            self.wiper.enqueue(tomb_name, size_in_g, on_done=on_done)
+            return
+
         self.vg.delete(name)
+        if on_done is not None:
+            on_done()
 
-    def _clear_volume(self, volume, is_snapshot=False):
-        # zero out old volumes to prevent data leaking between users
-        # TODO(ja): reclaiming space should be done lazy and low priority
-        if is_snapshot:
-            # if the volume to be cleared is a snapshot of another volume
-            # we need to clear out the volume using the -cow instead of the
-            # directly volume path.  We need to skip this if we are using
-            # thin provisioned LVs.
-            # bug# lp1191812
-            dev_path = self.local_path(volume) + "-cow"
-        else:
-            dev_path = self.local_path(volume)
+    def _clear_tombstone(self, entry):
+        """Zero a tombstone, IOPS-limited if runtime throttling is on."""
+        dev_path = self.local_path({'name': entry['name']})
 
-        # TODO(jdg): Maybe we could optimize this for snaps by looking at
-        # the cow table and only overwriting what's necessary?
-        # for now we're still skipping on snaps due to hang issue
         if not os.path.exists(dev_path):
             msg = (_LE('Volume device file path %s does not exist.')
                    % dev_path)
             LOG.error(msg)
             raise exception.VolumeBackendAPIException(data=msg)
 
-        size_in_g = volume.get('volume_size') or volume.get('size')
-        if size_in_g is None:
-            msg = (_LE("Size for volume: %s not found, "
-                   "cannot secure delete.") % volume['id'])
-            LOG.error(msg)
-            raise exception.InvalidParameterValue(msg)
+        devno = None
+        limit = self.configuration.ioarb_wipe_iops
+        if self.throttle is not None and limit > 0:
+            try:
+                devno = ioarbthrottle.get_devno(dev_path)
+                # wiping writes only.
+                self.throttle.set_limit(devno, limit, read_share=0.0)
+            except (OSError, processutils.ProcessExecutionError):
+                LOG.warning(_LW('[MRA] wiping %s without an IOPS limit')
+                            % entry['name'])
+                devno = None
 
-        # clear_volume expects sizes in MiB, we store integer GiB
-        # be sure to convert before passing in
-        vol_sz_in_meg = size_in_g * units.Ki
+        try:
+            # clear_volume expects sizes in MiB, we store integer GiB
+            volutils.clear_volume(
+                int(math.ceil(entry['size'])) * units.Ki, dev_path,
+                volume_clear=self.configuration.volume_clear,
+                volume_clear_size=self.configuration.volume_clear_size,
+                volume_clear_ionice=self.configuration.volume_clear_ionice)
+        finally:
+            if devno is not None:
+                try:
+                    self.throttle.clear_limit(devno)
+                except processutils.ProcessExecutionError:
+                    pass
+
+    def _remove_tombstone(self, entry):
+        self.vg.delete(entry['name'])
 
-        volutils.clear_volume(
-            vol_sz_in_meg, dev_path,
-            volume_clear=self.configuration.volume_clear,
-            volume_clear_size=self.configuration.volume_clear_size)
+    def _requeue_tombstones(self):
+        """Queue the tombstones left by a previous run.
+
+           Snapshot tombstones of earlier versions are removed at once.
+        """
+        prefix = CONF.volume_name_template.split('%')[0]
+        for lv in ioarbwipe.find_tombstones(self.vg.get_volumes()):
+            name = ioarbwipe.get_original_name(lv['name'])
+            if not name.startswith(prefix):
+                self.vg.delete(lv['name'])
+                continue
+            volid = name[len(prefix):]
+            self.wiper.enqueue(lv['name'], float(lv['size']),
+                               on_done=(lambda volid=volid:
+                                        self._get_resv_store().delete(volid)))
+        LOG.debug('[MRA] tombstones requeued: %s'
+                  % self.wiper.get_pending())
 
     def _escape_snapshot(self, snapshot_name):
         # Linux LVM reserves name that starts with snapshot, so that
@@ -242,7 +327,9 @@ class LVMVolumeDriver(driver.VolumeDriver):
 
         # Calculate the total volumes used by the VG group.
         # This includes volumes and snapshots.
-        total_volumes = len(self.vg.get_volumes())
+        # tombstones are volumes already deleted.
+        total_volumes = len([lv for lv in self.vg.get_volumes()
+                             if not ioarbwipe.is_tombstone(lv['name'])])
 
         # Skip enabled_pools setting, treat the whole backend as one pool
         # XXX FIXME if multipool support is added to LVM driver.
@@ -268,28 +355,201 @@ class LVMVolumeDriver(driver.VolumeDriver):
             ioarb_raidconf=self.configuration.ioarb_raidconf,
             ioarb_ndisk=self.configuration.ioarb_ndisk,
             total_iops_4k=self.configuration.ioarb_total_iops_4k,
-            provisioned_iops_4k=self.get_provisioned_iops_4k()
+            total_iops_4k_r=self.configuration.ioarb_total_iops_4k_r,
+            total_iops_4k_w=self.configuration.ioarb_total_iops_4k_w,
+            total_bw=self.configuration.ioarb_total_bw,
+            # space freed once pending wipes complete.
+            ioarb_wipe_pending_gb=self.wiper.get_pending_size(),
         ))
+
+        # provisioned amount of each qos resource type.
+        provisioned = self.get_provisioned_qos()
+        for rtype in ioarbiter.QOS_RTYPES:
+            prov_key = ioarbiter.CAPS_KEY_MAPPING[rtype][1]
+            single_pool[prov_key] = provisioned[rtype]
+
         data["pools"].append(single_pool)
 
         self._stats = data
 
+        self._update_iops_limits()
+
+    def get_total_qos(self):
+        """Total budget of each qos resource type this array knows."""
+        totals = {}
+        for rtype in ioarbiter.QOS_RTYPES:
+            total_key = ioarbiter.CAPS_KEY_MAPPING[rtype][0]
+            value = getattr(self.configuration, 'ioarb_' + total_key)
+            if value is not None:
+                totals[rtype] = float(value)
+
+        return totals
+
+    def _get_demands(self, stspec):
+        """Demands of a reservation on this array.
+
+           IOPS are counted as 4KB-equivalent IOPS of this array.
+        """
+        totals = self.get_total_qos()
+        iosize = ioarbiter.get_iosize(stspec)
+        return dict((rtype, ioarbiter.normalize_demand(
+                        rtype, ioarbiter.get_demand(stspec, rtype),
+                        iosize, totals))
+                    for rtype in ioarbresv.RESV_RTYPES)
+
+    def _get_resv_store(self):
+        """Reservation store of this array."""
+        if self._resv_store is None:
+            resv_fpath = ioarbresv.get_resv_filepath(
+                         '/dev/' + self.vg.vg_name.split('-')[-1])
+            self._resv_store = ioarbresv.ReservationStore(
+                resv_fpath, demand_fn=self._get_demands)
+        return self._resv_store
+
+    def get_provisioned_qos(self):
+        """Calculating provisioned amounts of each qos resource type."""
+
+        # running totals of the reservation store, checked against
+        # the whole file once in a while.
+        store = self._get_resv_store()
+        now = time.time()
+        interval = self.configuration.ioarb_resv_reconcile_interval
+        if now - self._resv_reconciled >= interval:
+            store.reconcile()
+            self._resv_reconciled = now
+        totals = store.get_totals()
+
+        return dict((rtype, totals.get(rtype, 0.0))
+                    for rtype in ioarbiter.QOS_RTYPES)
+
     def get_provisioned_iops_4k(self):
         """Calculating a provisioned IOPS."""
-        
-        resv_fpath = ioarbresv.get_resv_filepath(
-                     '/dev/' + self.vg.vg_name.split('-')[-1])
-        data = ioarbresv.get_resv_info(resv_fpath)
+        return self.get_provisioned_qos()[ioarbiter.RTYPE_IOPS4K]
 
-        #LOG.debug('[MRA] resv-info: %(resv)s' % {'resv': data})
+    def _setup_iops_throttle(self):
+        """Enforce IOPS limits of the volumes in the reservation map."""
+        if not self.configuration.ioarb_iops_throttle:
+            return
 
-        iops = 0
-        for volid in data:
-            for k, v in data[volid]:
-                if k == 'miniops':
-                    iops = iops + int(v)
+        found = ioarbthrottle.find_cgroup()
+        if found is None:
+            LOG.warning(_LW('[MRA] no blkio/io cgroup is found. '
+                            'IOPS limits are not enforced.'))
+            return
+        self.throttle = ioarbthrottle.CgroupThrottle(
+            found[0], found[1], utils.get_root_helper())
+        LOG.debug('[MRA] cgroup v%(ver)s: %(dir)s'
+                  % {'ver': found[0], 'dir': found[1]})
+
+        self._sync_iops_limits()
+
+    def _sync_iops_limits(self):
+        """Match the enforced IOPS limits with the reservation map.
+
+           The host driver reserves a volume before it runs lvcreate in
+           this container (the first volume of an array, bulk and warm
+           pool volumes), so a reserved volume may only get its LV after
+           create_volume() or startup. Such volumes are picked up here,
+           and limits of volumes no longer reserved (or whose LV is gone,
+           e.g. renamed to a tombstone) are removed.
+        """
+        data = self._get_resv_store().get_info()
+
+        for volid in data.keys() + self._iops_limits.keys():
+            volume = {'id': volid,
+                      'name': CONF.volume_name_template % volid}
+            present = (volid in data and
+                       os.path.exists(self.local_path(volume)))
+            if volid in self._iops_limits:
+                if not present:
+                    self._clear_iops_limit(volume)
+            elif present:
+                self._set_iops_limit(volume, data[volid])
+
+    def _set_iops_limit(self, volume, stspec):
+        """Start enforcing maxiops (and burst credits) of a volume."""
+        if self.throttle is None:
+            return
+
+        maxiops = float(stspec.get('maxiops', 0))
+        if maxiops <= 0:
+            return
+
+        credits = ioarbiter.BurstCredits(
+            stspec.get('miniops', 0), maxiops,
+            stspec.get('burstsec', ioarbiter.DEFAULT_BURST_SECONDS))
+        try:
+            devno = ioarbthrottle.get_devno(self.local_path(volume))
+            self.throttle.set_limit(devno, credits.get_limit())
+        except (OSError, processutils.ProcessExecutionError):
+            LOG.warning(_LW('[MRA] IOPS limit is not enforced: %s')
+                        % volume['id'])
+            return
+
+        self._iops_limits[volume['id']] = {
+            'devno': devno,
+            'credits': credits,
+            'limit': credits.get_limit(),
+            'read_share': 0.5,
+            'ios': None,
+            'time': None }
+
+    def _clear_iops_limit(self, volume):
+        """Remove the IOPS limit of a volume before it goes away."""
+        entry = self._iops_limits.pop(volume['id'], None)
+        if entry is None:
+            return
+
+        # device numbers are reused by later volumes.
+        try:
+            self.throttle.clear_limit(entry['devno'])
+        except processutils.ProcessExecutionError:
+            LOG.warning(_LW('[MRA] failed to clear IOPS limit of %s')
+                        % entry['devno'])
+
+    def _update_iops_limits(self):
+        """Switch volumes between maxiops and miniops by their credits."""
+        if self.throttle is None:
+            return
+
+        self._sync_iops_limits()
+        if not self._iops_limits:
+            return
 
-        return iops
+        try:
+            ios = self.throttle.get_ios()
+        except (IOError, ValueError) as err:
+            LOG.warning(_LW('[MRA] failed to read I/O stats: %s') % err)
+            return
+
+        now = time.time()
+        for entry in self._iops_limits.values():
+            count = ios.get(entry['devno'], (0, 0))
+            read_share = entry['read_share']
+            if entry['ios'] is not None:
+                reads = max(0, count[0] - entry['ios'][0])
+                writes = max(0, count[1] - entry['ios'][1])
+                entry['credits'].update(reads + writes, now - entry['time'])
+                # the limit is split between reads and writes by the
+                # recent mix, so that both together stay within it.
+                read_share = ioarbthrottle.get_read_share(reads, writes,
+                                                          read_share)
+            entry['ios'] = count
+            entry['time'] = now
+
+            limit = entry['credits'].get_limit()
+            if (limit == entry['limit'] and
+                    abs(read_share - entry['read_share']) <
+                    ioarbthrottle.MIN_SHARE):
+                continue
+            try:
+                self.throttle.set_limit(entry['devno'], limit,
+                                        read_share=read_share)
+                entry['limit'] = limit
+                entry['read_share'] = read_share
+            except processutils.ProcessExecutionError:
+                LOG.warning(_LW('[MRA] failed to set IOPS limit of %s')
+                            % entry['devno'])
 
     def check_for_setup_error(self):
         """Verify that requirements are in place to use LVM driver."""
@@ -339,6 +599,64 @@ class LVMVolumeDriver(driver.VolumeDriver):
                     raise exception.VolumeBackendAPIException(
                         data=exception_message)
 
+        self._replay_reservations()
+        self._setup_iops_throttle()
+        self._requeue_tombstones()
+
+    def _replay_reservations(self):
+        """Check the reservation map against the LVs of the VG.
+
+           The store is loaded from its snapshot and journal, then
+           compared with the result of a single lvs call. Reservations
+           of volumes that are gone are dropped and reserved sizes are
+           corrected, in one journal write.
+        """
+        store = self._get_resv_store()
+        store.reconcile()
+        self._resv_reconciled = time.time()
+
+        lvs = lvm.LVM.get_lv_info(utils.get_root_helper(),
+                                  vg_name=self.vg.vg_name)
+        # reservations of volumes being wiped are kept until they are
+        # gone. (see _delete_volume)
+        lv_sizes = dict((ioarbwipe.get_original_name(lv['name'])
+                         if ioarbwipe.is_tombstone(lv['name'])
+                         else lv['name'], lv['size']) for lv in lvs)
+
+        grace = self.configuration.ioarb_resv_replay_grace
+        now = time.time()
+        stale = []
+        resized = {}
+        reserved = set()
+        for volid, data in store.get_info().items():
+            name = CONF.volume_name_template % volid
+            reserved.add(name)
+            if not name in lv_sizes:
+                if now - store.get_time(volid) > grace:
+                    stale.append(volid)
+                continue
+
+            size = int(math.ceil(float(lv_sizes[name])))
+            # entries of older versions have no size.
+            if not 'size' in data or float(data['size']) != size:
+                data['size'] = size
+                resized[volid] = data
+
+        prefix = CONF.volume_name_template.split('%')[0]
+        for name in lv_sizes:
+            if name.startswith(prefix) and not name in reserved:
+                LOG.info(_LI('[MRA] no reservation for %s') % name)
+
+        if stale or resized:
+            LOG.warning(_LW('[MRA] reservation replay: dropping %(stale)s, '
+                            'resizing %(resized)s')
+                        % {'stale': stale, 'resized': resized.keys()})
+            store.update(adds=resized, deletes=stale)
+
+        LOG.debug('[MRA] reservations replayed up to seq %(seq)s: '
+                  '%(num)s volumes' % {'seq': store.seq,
+                                       'num': len(store.index)})
+
     def _retrieve_qos_info(self, ctxt, type_id):
         qosspec = {}
         volume_type = volume_types.get_volume_type(ctxt, type_id)
@@ -367,10 +685,10 @@ class LVMVolumeDriver(driver.VolumeDriver):
             qosspec = { ioarbiter.STTYPE: 'ioarb-unknown' }
 
         stspec = ioarbiter.translate_qosspec(qosspec)
-        resv_fpath = ioarbresv.get_resv_filepath(
-                     '/dev/' + self.vg.vg_name.split('-')[-1])
-        ioarbresv.add_resv_info(resv_fpath, volume['id'], stspec)
+        stspec['size'] = volume['size']
+        self._get_resv_store().add(volume['id'], stspec)
 
+        return stspec
 
     def create_volume(self, volume):
         """Creates a logical volume."""
@@ -384,7 +702,10 @@ class LVMVolumeDriver(driver.VolumeDriver):
                             mirror_count)
 
         # [MRA] for admission control.
-        self.add_resv_info(volume)
+        stspec = self.add_resv_info(volume)
+
+        # [MRA] for runtime enforcement.
+        self._set_iops_limit(volume, stspec)
 
 
     def create_volume_from_snapshot(self, volume, snapshot):
@@ -422,12 +743,12 @@ class LVMVolumeDriver(driver.VolumeDriver):
                           'for volume: %s') % volume['name'])
             raise exception.VolumeIsBusy(volume_name=volume['name'])
 
-        self._delete_volume(volume)
-        
-        # [MRA] remove it from the reservation map.
-        resv_fpath = ioarbresv.get_resv_filepath(
-                     '/dev/' + self.vg.vg_name.split('-')[-1])
-        ioarbresv.delete_resv_info(resv_fpath, volume['id'])
+        self._clear_iops_limit(volume)
+
+        # [MRA] remove it from the reservation map once it is wiped.
+        self._delete_volume(
+            volume,
+            on_done=lambda: self._get_resv_store().delete(volume['id']))
 
         LOG.info(_LI('Successfully deleted volume: %s'), volume['id'])
 
@@ -447,8 +768,7 @@ class LVMVolumeDriver(driver.VolumeDriver):
             LOG.info(_LI('Successfully deleted snapshot: %s'), snapshot['id'])
             return True
 
-        # TODO(yamahata): zeroing out the whole snapshot triggers COW.
-        # it's quite slow.
+        # [MRA] removed at once, not zeroed. (see _delete_volume)
         self._delete_volume(snapshot, is_snapshot=True)
 
     def local_path(self, volume, vg=None):
@@ -546,6 +866,13 @@ class LVMVolumeDriver(driver.VolumeDriver):
         self.vg.extend_volume(volume['name'],
                               self._sizestr(new_size))
 
+        # [MRA] keep the reserved size in sync.
+        store = self._get_resv_store()
+        data = store.get(volume['id'])
+        if data is not None:
+            data['size'] = new_size
+            store.add(volume['id'], data)
+
     def manage_existing(self, volume, existing_ref):
         """Manages an existing LV.
 